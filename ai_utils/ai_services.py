@@ -5,8 +5,8 @@ from ai_utils.gemini import gemini_query
 from ai_utils.aws import aws_query
 from ai_utils.anthropic import anthropic_query
 
-@cache_function(batch_mode=True)  # Batch mode for ai_query
-def ai_query(queries, role=None, format=None, chat_history=None, ai_service='openai', model='gpt-4o-mini', disable_cache=False):
+@cache_function(batch_mode=True, ignore_args=('disable_cache', 'batch_process'))  # Batch mode for ai_query
+def ai_query(queries, role=None, format=None, chat_history=None, ai_service='openai', model='gpt-4o-mini', disable_cache=False, batch_process=None):
     """Summarize content based on the selected AI service."""
     if ai_service == 'azure':
         return azure_query(queries)
@@ -17,4 +17,4 @@ def ai_query(queries, role=None, format=None, chat_history=None, ai_service='ope
     elif ai_service == 'anthropic':
         return anthropic_query(queries)
     else:
-        return gpt_query(queries, role, format, chat_history, model)
+        return gpt_query(queries, role, format, chat_history, model, batch_process)
@@ -1,7 +1,7 @@
 # Anthropic AI Claude integration
 
-import requests
 from config import config
+from utils.http_client import http_client
 
 def anthropic_query(query):
     anthropic_api_url = config['ai_services']['anthropic']['api_url']
@@ -10,5 +10,5 @@ def anthropic_query(query):
     headers = {"Authorization": f"Bearer {anthropic_api_key}"}
     payload = {"prompt": f"Summarize the following content:\n{query}", "max_tokens": 150}
 
-    response = requests.post(anthropic_api_url, headers=headers, json=payload)
+    response = http_client.post(anthropic_api_url, headers=headers, json=payload)
     return response.json()['choices'][0]['text'].strip()
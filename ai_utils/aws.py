@@ -1,7 +1,7 @@
 # AWS AI integration
 
-import requests
 from config import config
+from utils.http_client import http_client
 
 def aws_query(query):
     aws_api_url = config['ai_services']['aws']['api_url']
@@ -10,6 +10,6 @@ def aws_query(query):
     headers = {"Authorization": f"Bearer {aws_api_key}"}
     payload = {"prompt": f"Summarize the following content:\n{query}", "max_tokens": 150}
 
-    response = requests.post(aws_api_url, headers=headers, json=payload)
+    response = http_client.post(aws_api_url, headers=headers, json=payload)
     return response.json()['choices'][0]['text'].strip()
 
@@ -1,7 +1,7 @@
 # Azure OpenAI integration
 
-import requests
 from config import config
+from utils.http_client import http_client
 
 def azure_query(query):
     azure_api_url = config['ai_services']['azure']['api_url']
@@ -10,5 +10,5 @@ def azure_query(query):
     headers = {"Ocp-Apim-Subscription-Key": azure_api_key}
     payload = {"prompt": f"Summarize the following content:\n{query}", "max_tokens": 150}
 
-    response = requests.post(azure_api_url, headers=headers, json=payload)
+    response = http_client.post(azure_api_url, headers=headers, json=payload)
     return response.json()['choices'][0]['text'].strip()
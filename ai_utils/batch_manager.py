@@ -0,0 +1,316 @@
+# OpenAI Batch API job tracking
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+TERMINAL_FAILURES = ('failed', 'expired', 'cancelled')
+
+class BatchJobManager:
+    """
+    Submits OpenAI Batch API jobs and keeps track of them in a JSON file.
+
+    Each job is identified by a fingerprint of its requests. Submitting the same requests again, e.g. after the process
+    was restarted, resumes the job that is already in flight instead of creating (and paying for) a new one. Jobs left
+    by a previous run also answer the requests they share with a later, different set of requests (e.g. when some of
+    them were cached in between), only the requests they don't cover are submitted again.
+    """
+    def __init__(self, client_factory, folder='data/batch_requests', poll_min=5, poll_max=30, max_requests=50000, max_bytes=190000000, max_parallel_jobs=8):
+        """
+        :param client_factory: Function returning the OpenAI client
+        :param folder: Folder where the request and result files and the job list (batch_jobs.json) are saved
+        :param poll_min: Initial interval in seconds between status checks
+        :param poll_max: Maximum interval in seconds between status checks, reached while a job makes no progress
+        :param max_requests: Maximum number of requests in one batch job
+        :param max_bytes: Maximum size in bytes of the request file of one batch job
+        :param max_parallel_jobs: Maximum number of batch jobs uploaded and followed at once
+        """
+        self.client_factory = client_factory
+        self.folder = folder
+        self.jobs_file = os.path.join(folder, 'batch_jobs.json')
+        self.poll_min = float(poll_min)
+        self.poll_max = float(poll_max)
+        self.max_requests = int(max_requests)
+        self.max_bytes = int(max_bytes)
+        self.max_parallel_jobs = int(max_parallel_jobs)
+        self.lock = threading.Lock()
+        self.following = set()  # fingerprints of the jobs submitted or resumed by this process and not collected yet
+
+    def _load_jobs(self):
+        if not os.path.exists(self.jobs_file):
+            return {}
+        with open(self.jobs_file, 'r') as file:
+            return json.load(file)
+
+    def _save_jobs(self, jobs):
+        tmp_file = f"{self.jobs_file}.tmp"
+        with open(tmp_file, 'w') as file:
+            json.dump(jobs, file, indent=2)
+        os.replace(tmp_file, self.jobs_file)  # atomic, a crash never leaves a truncated job list
+
+    def _update(self, job):
+        with self.lock:
+            jobs = self._load_jobs()
+            jobs[job['fingerprint']] = job
+            self._save_jobs(jobs)
+
+    def forget(self, job):
+        """Remove a job from the job list once its results are collected."""
+        with self.lock:
+            jobs = self._load_jobs()
+            jobs.pop(job['fingerprint'], None)
+            self._save_jobs(jobs)
+
+    def pending_jobs(self):
+        """Return the jobs submitted and not collected yet."""
+        with self.lock:
+            return list(self._load_jobs().values())
+
+    @staticmethod
+    def request_fingerprint(task):
+        """Fingerprint of the body of a batch request, regardless of its custom_id."""
+        return hashlib.blake2b(json.dumps(task['body'], sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def fingerprint(tasks):
+        """Fingerprint of the batch requests, identical requests give identical fingerprints."""
+        hasher = hashlib.blake2b(digest_size=16)
+        for task in tasks:
+            hasher.update(json.dumps(task, sort_keys=True).encode())
+        return hasher.hexdigest()
+
+    def shard(self, tasks):
+        """Split the requests, keeping their order, into shards within the request count and file size limits of a batch job."""
+        shards = []
+        current = []
+        current_bytes = 0
+        for task in tasks:
+            task_bytes = len(json.dumps(task).encode()) + 1  # one JSONL line
+            if current and (len(current) >= self.max_requests or current_bytes + task_bytes > self.max_bytes):
+                shards.append(current)
+                current = []
+                current_bytes = 0
+            current.append(task)
+            current_bytes += task_bytes
+        if current:
+            shards.append(current)
+        return shards
+
+    def run(self, tasks):
+        """
+        Run the requests as one or more batch jobs, split by shard and processed concurrently, and merge their results.
+
+        A shard that fails doesn't discard the results of the others, its requests are mapped to {'error': message}.
+
+        :param tasks: List of Batch API requests, each with a unique custom_id
+        :return: Dictionary of custom_id and response content of all the requests
+        """
+        responses = self.resume_pending(tasks)
+        tasks = [task for task in tasks if task['custom_id'] not in responses]
+        if not tasks:
+            return responses
+        shards = self.shard(tasks)
+        if len(shards) == 1:
+            responses.update(self._run_job(shards[0]))
+            return responses
+
+        print(f"[OpenAI API] Splitting {len(tasks)} requests into {len(shards)} batch jobs")
+        with ThreadPoolExecutor(max_workers=min(len(shards), self.max_parallel_jobs)) as executor:
+            futures = {executor.submit(self._run_job, shard): shard for shard in shards}
+            for future in as_completed(futures):
+                try:
+                    responses.update(future.result())
+                except Exception as e:
+                    print(f"[OpenAI API] Batch job of {len(futures[future])} requests failed: {e}")
+                    responses.update({task['custom_id']: {'error': str(e)} for task in futures[future]})
+        return responses
+
+    def resume_pending(self, tasks):
+        """
+        Collect the jobs of previous runs sharing requests with tasks, matched by request body, and return their responses
+        to those requests by the custom_id of tasks. Failed requests aren't returned, so they are submitted again, and jobs
+        sharing no request are left for a later run.
+        """
+        requests = {}  # request fingerprint -> custom ids of tasks
+        for task in tasks:
+            requests.setdefault(self.request_fingerprint(task), []).append(task['custom_id'])
+        responses = {}
+        for job in self.pending_jobs():
+            try:
+                with open(job['input_file'], 'r', encoding='utf-8') as file:
+                    job_requests = {task['custom_id']: self.request_fingerprint(task) for task in (json.loads(line) for line in file if line.strip())}
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[OpenAI API] Could not read the requests of batch job {job['batch_id']}: {e}")
+                continue
+            if not any(fingerprint in requests for fingerprint in job_requests.values()):
+                continue
+            with self.lock:
+                if job['fingerprint'] in self.following:  # collected by another call of this process
+                    continue
+                self.following.add(job['fingerprint'])
+            print(f"[OpenAI API] Resuming batch job {job['batch_id']} submitted at {job['submitted_at']}, it shares requests with this run")
+            try:
+                job_responses = self.finish(job)
+            except Exception as e:
+                print(f"[OpenAI API] Batch job {job['batch_id']} failed: {e}")
+                continue
+            for job_custom_id, fingerprint in job_requests.items():
+                response = job_responses.get(job_custom_id)
+                if response is None or isinstance(response, dict):
+                    continue
+                for custom_id in requests.get(fingerprint, []):
+                    responses[custom_id] = response
+        return responses
+
+    def _run_job(self, tasks):
+        """Submit (or resume) a single batch job, wait for it and collect its results."""
+        return self.finish(self.submit(tasks))
+
+    def finish(self, job):
+        """Wait for a submitted job, collect its results and forget it."""
+        try:
+            batch_job = self.wait(job)
+            if batch_job.status != "completed":
+                print(f"[OpenAI API] Job {batch_job.id} has {batch_job.status} with error {batch_job.errors}")
+                if not batch_job.output_file_id and not batch_job.error_file_id:
+                    self.forget(job)
+                    raise RuntimeError(f"Batch job {batch_job.id} has {batch_job.status}: {batch_job.errors}")
+            try:
+                return self.collect(job, batch_job)
+            finally:
+                self.forget(job)
+        finally:
+            with self.lock:
+                self.following.discard(job['fingerprint'])
+
+    def submit(self, tasks):
+        """
+        Write the requests to a JSONL file, upload it and create the batch job, unless the same requests are already in flight.
+
+        :param tasks: List of Batch API requests, each with its custom_id
+        :return: The job record (fingerprint, batch id, input file, custom ids and status)
+        """
+        fingerprint = self.fingerprint(tasks)
+        with self.lock:
+            self.following.add(fingerprint)
+            job = self._load_jobs().get(fingerprint)
+        if job and job['status'] not in TERMINAL_FAILURES:
+            print(f"[OpenAI API] Resuming batch job {job['batch_id']} submitted at {job['submitted_at']}")
+            return job
+
+        time_stamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        file_name = os.path.join(self.folder, f"batch_tasks_{time_stamp}_{fingerprint[:8]}.jsonl")
+        with open(file_name, 'w') as file:
+            for task in tasks:
+                file.write(json.dumps(task) + '\n')
+
+        client = self.client_factory()
+        with open(file_name, "rb") as file:
+            batch_file = client.files.create(file=file, purpose="batch")
+        batch_job = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+            )
+
+        job = {
+            'fingerprint': fingerprint,
+            'batch_id': batch_job.id,
+            'input_file': file_name,
+            'input_file_id': batch_file.id,
+            'custom_ids': [task['custom_id'] for task in tasks],
+            'status': batch_job.status,
+            'submitted_at': time_stamp
+        }
+        self._update(job)
+        print(f"[OpenAI API] Submitted batch job {batch_job.id} with {len(tasks)} requests")
+        return job
+
+    def wait(self, job):
+        """
+        Poll the job until it ends. The interval starts at poll_min and grows up to poll_max while the job makes no progress.
+
+        :return: The OpenAI batch object in its final state
+        """
+        client = self.client_factory()
+        delay = self.poll_min
+        completed = None
+        while True:
+            batch_job = client.batches.retrieve(job['batch_id'])
+            if batch_job.status != job['status']:
+                job['status'] = batch_job.status
+                self._update(job)
+            if batch_job.status in TERMINAL_FAILURES or batch_job.status == 'completed':
+                print(f"[OpenAI API] Job {batch_job.id} has finished with status {batch_job.status}")
+                return batch_job
+            elif batch_job.status == 'in_progress':
+                print(f'[OpenAI API] Job {batch_job.id} is in progress, {batch_job.request_counts.completed}/{batch_job.request_counts.total} requests completed')
+            elif batch_job.status == 'finalizing':
+                print(f'[OpenAI API] Job {batch_job.id} is finalizing, waiting for the output file id')
+
+            progress = batch_job.request_counts.completed if batch_job.request_counts else None
+            delay = self.poll_min if progress != completed else min(delay * 1.5, self.poll_max)
+            completed = progress
+            time.sleep(delay)
+
+    def collect(self, job, batch_job):
+        """
+        Download the results of a finished job, including the partial results of expired or cancelled jobs.
+
+        :return: Dictionary of custom_id and response content, or {'error': message} for the requests that failed
+        """
+        base_name = job['input_file'][:-len('.jsonl')]
+        if not batch_job.output_file_id and not batch_job.error_file_id:
+            print(f"[OpenAI API] Job {batch_job.id} has failed.")
+            print(f"[OpenAI API] There was probably an error in the queries submited file {job['input_file']}")
+            raise RuntimeError(f"Batch job {batch_job.id} returned no output: {batch_job.errors}")
+
+        responses = {}
+        if batch_job.output_file_id:
+            self.parse_results(self.download(batch_job.output_file_id, f"{base_name}_results.jsonl"), responses)
+        if batch_job.error_file_id:
+            error_file_name = self.download(batch_job.error_file_id, f"{base_name}_error.jsonl")
+            self.parse_results(error_file_name, responses)
+            print(f"[OpenAI API] Some requests of job {batch_job.id} failed, you can find more details at the file {error_file_name}")
+        return responses
+
+    def download(self, file_id, file_name):
+        """Stream a file from the OpenAI API to disk in chunks, so large result files never sit in memory."""
+        client = self.client_factory()
+        with client.files.with_streaming_response.content(file_id) as response:
+            with open(file_name, 'wb') as file:
+                for chunk in response.iter_bytes(chunk_size=1024 * 1024):
+                    file.write(chunk)
+        return file_name
+
+    @staticmethod
+    def parse_results(file_name, responses=None):
+        """
+        Parse a results or error file line by line into a dictionary of custom_id and response content.
+
+        Requests that failed are mapped to {'error': message}, a malformed line is reported and skipped without stopping the parsing.
+        """
+        responses = {} if responses is None else responses
+        with open(file_name, 'r', encoding='utf-8') as file:
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                custom_id = None
+                try:
+                    batch = json.loads(line)
+                    custom_id = batch.get('custom_id')
+                    if batch.get('error'):
+                        raise ValueError(batch['error'].get('message') if isinstance(batch['error'], dict) else batch['error'])
+                    response = batch['response']
+                    if response.get('status_code', 200) != 200:
+                        raise ValueError(f"Status code {response['status_code']}: {(response.get('body') or {}).get('error')}")
+                    responses[custom_id] = response['body']['choices'][0]['message']['content'].strip()
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                    print(f"[OpenAI API] Error in line {line_number} of {file_name}: {e}")
+                    if custom_id and custom_id not in responses:
+                        responses[custom_id] = {'error': str(e)}
+        return responses
@@ -1,7 +1,7 @@
 # Google Gemini integration
 
-import requests
 from config import config
+from utils.http_client import http_client
 
 def gemini_query(query):
     gemini_api_url = config['ai_services']['gemini']['api_url']
@@ -10,5 +10,5 @@ def gemini_query(query):
     headers = {"Authorization": f"Bearer {gemini_api_key}"}
     payload = {"prompt": f"Summarize the following content:\n{query}", "max_tokens": 150}
 
-    response = requests.post(gemini_api_url, headers=headers, json=payload)
+    response = http_client.post(gemini_api_url, headers=headers, json=payload)
     return response.json()['choices'][0]['text'].strip()
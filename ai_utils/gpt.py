@@ -1,15 +1,61 @@
 # OpenAI GPT integration
 
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 from openai import OpenAI
 from config import config
-import datetime
-import time
+from ai_utils.batch_manager import BatchJobManager
+from utils.rate_limiter import MinuteRateLimiter
+from utils.tokens import count_message_tokens
 
-def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-mini"):
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the OpenAI client shared by all calls, created on first use so its connection pool is reused."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            http = config['http']
+            _client = OpenAI(
+                api_key=config['ai_services']['gpt']['api_key'],
+                max_retries=int(http['max_retries']), # the SDK retries 429/5xx with jittered backoff
+                timeout=float(http['timeout']),
+                http_client=httpx.Client(limits=httpx.Limits(max_connections=int(http['pool_maxsize']), max_keepalive_connections=int(http['pool_maxsize'])))
+            )
+        return _client
+
+# Tracks submitted batch jobs so they are resumed instead of resubmitted after a restart
+batch_manager = BatchJobManager(get_client, poll_min=config['batch_poll_min'], poll_max=config['batch_sleep'], max_requests=config['batch_max_requests'], max_bytes=config['batch_max_bytes'], max_parallel_jobs=config['batch_max_parallel_jobs'])
+
+# Requests and tokens per minute of the realtime calls, corrected by the rate limit headers of every response
+realtime_limiter = MinuteRateLimiter(config['ai_services']['gpt'].get('rpm'), config['ai_services']['gpt'].get('tpm'))
+
+def query_chat_history(chat_history, index):
+    """Chat history of the index query, chat_history being either a single conversation or one conversation per query."""
+    if not chat_history:
+        return []
+    if isinstance(chat_history[0], dict):
+        return chat_history
+    return chat_history[index] or []
+
+def realtime_query(client, model, messages, response_format):
+    """Send a single chat completion request within the requests and tokens per minute limits."""
+    realtime_limiter.acquire(count_message_tokens(messages, model))  # counted like the prompt budget of llm_max_prompt_tokens
+    raw_response = client.chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        response_format=response_format
+    )
+    realtime_limiter.update(raw_response.headers)
+    return raw_response.parse().choices[0].message.content.strip()
+
+def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-mini", batch_process=None):
     """
-    Process queries in batch if there is more than one query in queries,
-    otherwise handle them individually.
+    Process queries with the Batch API, or concurrently with realtime requests
+    when batch processing is disabled.
     
     Args:
         queries (list): List of queries to be processed.
@@ -17,6 +63,7 @@ def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-
         format (dict): Format for the response.
         chat_history (list): Chat history to be sent to the model.
         model (str): The model to be used.
+        batch_process (bool): Use the Batch API instead of concurrent realtime calls, llm_batch_process by default.
         
     Returns:
         tuple: A tuple containing:
@@ -24,7 +71,7 @@ def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-
             - current_chat_instance (list): List of user queries and corresponding AI responses.
             - full_history (list): Full history of the conversation without specific roles.
     """
-    client = OpenAI(api_key=config['ai_services']['gpt']['api_key'])
+    client = get_client()
     
     # Initialize chat_history if it is None or empty
     if chat_history is None:
@@ -38,7 +85,8 @@ def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-
         queries = [queries]
     
     # Determine whether to process in batch or individually based
-    batch_process = config['llm_batch_process']
+    if batch_process is None:
+        batch_process = config['llm_batch_process']
 
     if batch_process:
         # Collect all messages for the batch request
@@ -62,77 +110,24 @@ def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-
                     "response_format": query_format
                 }
             }
-            json.loads(format[index])
             messages_batch.append(task)
-        
-        now = datetime.datetime.now()
-        time_stamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-        file_name = f"data/batch_requests/batch_tasks_{time_stamp}.jsonl"
-
-        with open(file_name, 'w') as file:
-            for obj in messages_batch:
-                file.write(json.dumps(obj) + '\n')
 
         try:
-            #upload batch file 
-            batch_file = client.files.create(
-                file=open(file_name, "rb"),
-                purpose="batch"
-                )
-            
-            batch_job = client.batches.create(
-                input_file_id=batch_file.id,
-                endpoint="/v1/chat/completions",
-                completion_window="24h"
-                )
-            
-            while True:
-                batch_job = client.batches.retrieve(batch_job.id)
-                if batch_job.status == "failed":
-                    print(f"[OpenAI API] Job {batch_job.id} has failed with error {batch_job.errors}")
-                    return [{'error': batch_job.errors}], None, None
-                elif batch_job.status == 'in_progress':
-                    print(f'[OpenAI API] Job {batch_job.id} is in progress, {batch_job.request_counts.completed}/{batch_job.request_counts.total} requests completed')
-                elif batch_job.status == 'finalizing':
-                    print(f'[OpenAI API] Job {batch_job.id} is finalizing, waiting for the output file id')
-                elif batch_job.status == "completed":
-                    print(f"[OpenAI API] Job {batch_job.id} has finished")
-                    break
-                time.sleep(int(config['batch_sleep']))
-            
-            result_file_id = batch_job.output_file_id
-            if result_file_id:
-                result = client.files.content(result_file_id).content
-                result_file_name = f"data/batch_requests/batch_tasks_{time_stamp}_results.jsonl"
-                with open(result_file_name, 'wb') as file:
-                    file.write(result)
-            else:
-                print(f"[OpenAI API] Job {batch_job.id} has failed.")
-                print(f"[OpenAI API] There was probably an error in the queries submited file {file_name}")
-                error_file_id = batch_job.error_file_id
-                error = client.files.content(error_file_id).content
-                error_file_name = f"data/batch_requests/batch_tasks_{time_stamp}_error.jsonl"
-                with open(error_file_name, 'wb') as file:
-                    file.write(error)
-                print(f"[OpenAI API] You can find more details at the file {error_file_name}")
-                return [{'error': batch_job.errors}], None, None
-
-            results = []
-            with open(result_file_name, 'r') as file:
-                for line in file:
-                    json_object = json.loads(line.strip())
-                    results.append(json_object)
-            
-            # Collect and reorder all responses from the batch based on custom_id
-            response_dict = {batch['custom_id']: batch['response']['body']['choices'][0]['message']['content'].strip() for batch in results}
-            ordered_responses = [response_dict[f"query_{index}"] for index in range(len(queries))]
+            # Submit the jobs, or resume them when the same requests were submitted by a previous run
+            response_dict = batch_manager.run(messages_batch)
+            # Reorder all responses from the batch based on custom_id, requests without a response are reported as errors
+            ordered_responses = [response_dict.get(f"query_{index}", {'error': f"No response for query_{index} in the batch results"}) for index in range(len(queries))]
         
         except Exception as e:
-            return [{'error': str(e)}], None, None
+            # Report the error for every query so each one is left out of the cache
+            return [{'error': str(e)}] * len(queries), [None] * len(queries), [None] * len(queries)
         
         # Create current chat instance for batch calls
         current_chat_instance = []
         for index, query in enumerate(queries):
+            if isinstance(ordered_responses[index], dict): # failed request
+                current_chat_instance.append(None)
+                continue
             current_chat_instance.append([
                 {"role": "user", "content": query},
                 {"role": "system", "content": ordered_responses[index]}
@@ -145,45 +140,50 @@ def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-
 
         # Append current_chat_instance to full_history
         for chat in current_chat_instance:
-            full_history.extend(chat)
+            if chat:  # Ensure we only add valid chat instances
+                full_history.extend(chat)
 
         return ordered_responses, current_chat_instance, full_history
 
     else:
-        # Process each query individually
-        responses = []
-        current_chat_instance = []
-        query = queries[0]
-        query_role = role[0] if isinstance(role, list) else role 
-        query_format = {"type": "text"} if not format else json.loads(format[0]) if isinstance(role, list) else json.loads(format)
-        query_chat_history = chat_history[0] if isinstance(chat_history[0], list) else chat_history 
-        try:
-            messages = query_chat_history + [  # Include the chat history for this specific query
-                {"role": "system", "content": query_role or "Default system role"},
-                {"role": "user", "content": query}
-            ]
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                response_format= query_format
-            )
-            assistant_response = response.choices[0].message.content.strip()
-            responses.append(assistant_response)
+        # Process the queries concurrently in realtime, up to llm_realtime_max_workers requests in flight
+        def run_query(index):
+            query = queries[index]
+            query_role = role[index] if isinstance(role, list) else role
+            try:
+                # Parsed per query, an empty format (e.g. an empty sheet cell) is plain text and an invalid one fails this query only
+                query_format = format[index] if isinstance(format, list) else format
+                query_format = json.loads(query_format) if query_format else {"type": "text"}
+                messages = query_chat_history(chat_history, index) + [  # Include the chat history for this specific query
+                    {"role": "system", "content": query_role or "Default system role"},
+                    {"role": "user", "content": query}
+                ]
+                assistant_response = realtime_query(client, model, messages, query_format)
+                # Create current chat instance for individual calls
+                return assistant_response, [
+                    {"role": "user", "content": query},
+                    {"role": "system", "content": assistant_response}
+                ]
+            except Exception as e:
+                return {'error': str(e)}, None
 
-            # Create current chat instance for individual calls
-            current_chat_instance.append([
-                {"role": "user", "content": query},
-                {"role": "system", "content": assistant_response}
-            ])
-            
-        except Exception as e:
-            responses.append({'error': str(e)})
-            current_chat_instance.append(None)
+        max_workers = max(1, min(int(config.get('llm_realtime_max_workers') or 1), len(queries)))
+        if max_workers > 1:
+            print(f"[OpenAI API] Sending {len(queries)} requests with up to {max_workers} in flight")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(run_query, range(len(queries))))
+        else:
+            results = [run_query(index) for index in range(len(queries))]
+        responses = [response for response, _ in results]
+        current_chat_instance = [chat for _, chat in results]
         
         # Create full history
         full_history = []
-        for history in chat_history:
-            full_history.extend(history)
+        if chat_history and isinstance(chat_history[0], dict):
+            full_history.extend(chat_history)
+        else:
+            for history in chat_history:
+                full_history.extend(history or [])
 
         # Append current_chat_instance to full_history
         for chat in current_chat_instance:
@@ -191,6 +191,3 @@ def gpt_query(queries, role=None, format=None, chat_history=None, model="gpt-4o-
                 full_history.extend(chat)
                 
         return responses, current_chat_instance, full_history
-
-
-
@@ -0,0 +1,80 @@
+# Cache maintenance commands, run from the project folder: python -m cache <command>
+import argparse
+import datetime
+import json
+import sys
+from cache.cache import cache_db
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m cache', description='Cache database maintenance')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help='Show the number of entries and stored bytes per function')
+    subparsers.add_parser('compact', help='Delete expired entries, enforce the size limits and vacuum the database file')
+    migrate = subparsers.add_parser('migrate', help='Rewrite legacy pickle values with the configured codec')
+    migrate.add_argument('--batch-size', type=int, default=1000, help='Rows rewritten per transaction')
+    search = subparsers.add_parser('search', help='Full text search of the cached results, function names and queries')
+    search.add_argument('query', help="FTS5 query, e.g. 'child labour', '\"child labour\"', 'content: child*' or 'query: child*'")
+    search.add_argument('--function', help='Only search entries of this function, e.g. ai_query')
+    search.add_argument('--limit', type=int, default=20, help='Entries per page')
+    search.add_argument('--page', type=int, default=1, help='Page of results to show')
+    search.add_argument('--delete', action='store_true', help='Delete all matching entries instead of listing them')
+    subparsers.add_parser('reindex', help='Rebuild the full text index from the stored results')
+    export = subparsers.add_parser('export', help='Stream cache entries as JSON lines')
+    export.add_argument('--function', help='Only export entries of this function, e.g. perform_search')
+    export.add_argument('--prefix', help='Only export entries whose key starts with this prefix')
+    export.add_argument('--since', type=datetime.date.fromisoformat, help='Only entries created on or after this date (YYYY-MM-DD)')
+    export.add_argument('--until', type=datetime.date.fromisoformat, help='Only entries created before this date (YYYY-MM-DD)')
+    export.add_argument('--output', help='Output file, standard output by default')
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        for func_name, stats in cache_db.stats().items():
+            print(f"[Cache] {func_name or 'unknown'}: {stats['entries']} entries, {stats['bytes']} bytes")
+    elif args.command == 'compact':
+        deleted = cache_db.compact()
+        print(f"[Cache] Compaction finished, {deleted} entries deleted")
+    elif args.command == 'migrate':
+        migrated = cache_db.migrate_values(args.batch_size)
+        print(f"[Cache] Migration finished, {migrated} values rewritten. Run 'python -m cache compact' to reclaim the freed space")
+    elif args.command == 'search':
+        search_cache(args)
+    elif args.command == 'reindex':
+        indexed = cache_db.rebuild_index()
+        print(f"[Cache] Full text index rebuilt for {indexed} entries")
+    elif args.command == 'export':
+        export_cache(args)
+
+def to_timestamp(date):
+    return datetime.datetime.combine(date, datetime.time()).timestamp() if date else None
+
+def export_cache(args):
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    exported = 0
+    try:
+        for entry in cache_db.iter_cache(prefix=args.prefix, func_name=args.function, created_after=to_timestamp(args.since), created_before=to_timestamp(args.until)):
+            output.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+            exported += 1
+    finally:
+        if args.output:
+            output.close()
+    print(f"[Cache] Exported {exported} entries", file=sys.stderr)
+
+def search_cache(args):
+    if args.delete:
+        keys = []
+        while True:
+            matches = cache_db.search_cache(args.query, limit=1000, offset=len(keys), func_name=args.function)
+            keys.extend(match['key'] for match in matches)
+            if len(matches) < 1000:
+                break
+        cache_db.delete_cache(keys)
+        print(f"[Cache] Deleted {len(keys)} matching entries")
+        return
+
+    matches = cache_db.search_cache(args.query, limit=args.limit, offset=(args.page - 1) * args.limit, func_name=args.function)
+    for match in matches:
+        print(f"{match['key']} ({match['func_name'] or 'unknown'}): {cache_db.result_text(match['result'])[:200]}")
+    print(f"[Cache] Page {args.page}, {len(matches)} entries")
+
+if __name__ == "__main__":
+    main()
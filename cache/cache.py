@@ -1,13 +1,96 @@
+import atexit
 import hashlib
+import inspect
+import json
 import pickle
+import time
 from functools import wraps
+from config import config
 from cache.cache_database import CacheDatabase
+from cache.memory_cache import MemoryCache
+from cache.in_flight import InFlightCalls
+
+# Namespace of the cache keys, bump it whenever the key encoding changes
+CACHE_KEY_VERSION = 'v2'
+# Arguments added after the legacy keys were replaced, the callers of that version never passed them
+LEGACY_NEW_ARGS = ('batch_process',)
 
 # Initialize the cache database
-cache_db = CacheDatabase()
+cache_db = CacheDatabase(ttl=config['cache']['ttl'], max_entries=config['cache']['max_entries'], max_bytes=config['cache']['max_bytes'], eviction_policy=config['cache']['eviction_policy'], compression=config['cache']['compression'], full_text_index=config['cache']['full_text_index'])
+
+# Accesses are written in batches, the last ones when the process exits
+atexit.register(cache_db.flush_access)
+
+# In-process LRU tier in front of the cache database
+memory_cache = MemoryCache(config['cache']['memory_max_entries'], config['cache']['memory_max_bytes'])
+
+# Calls in progress, concurrent misses for the same key wait for the first call instead of repeating it
+in_flight = InFlightCalls()
+
+def load_cached(keys):
+    """Load cache entries from memory, falling back to the database for the keys not held in memory."""
+    found = {}
+    missing = []
+    for key in keys:
+        value = memory_cache.get(key)
+        if value is None:
+            missing.append(key)
+        else:
+            found[key] = value
+    if missing:
+        expiry = {}
+        for key, value in cache_db.load_many(missing, expiry).items():
+            memory_cache.put(key, value, expiry.get(key))
+            found[key] = value
+    return found
+
+def save_cached(items, func_name=None, arguments=None):
+    """Save cache entries to memory and write them through to the database."""
+    items = list(items)
+    expires_at = cache_db.expires_at(func_name, time.time())
+    for key, value in items:
+        memory_cache.put(key, value, expires_at)
+    cache_db.save_many(items, func_name, arguments)
+
+def delete_cached(keys):
+    """Delete cache entries from both memory and the database."""
+    memory_cache.delete(keys)
+    cache_db.delete_cache(keys)
+
+def is_error(value):
+    """Check whether a value is an error dictionary, e.g. {'error': message} returned for a failed request."""
+    return isinstance(value, dict) and 'error' in value
+
+def has_error(result):
+    """
+    Check whether a result is an error that must not be cached: an error dictionary, or a tuple or list with one as a
+    direct part. The responses of a single ai_query call are a list part of its result, so their errors count too.
+    Strings are never errors, whatever their text.
+    """
+    if is_error(result):
+        return True
+    if isinstance(result, (list, tuple)):
+        return any(is_error(part) or (isinstance(part, list) and any(is_error(item) for item in part)) for part in result)
+    return False
+
+def encode_arguments(func_name, signature, args, kwargs, ignore_args=()):
+    """
+    Encode the function name and its arguments deterministically.
+
+    Arguments are bound to the function signature, so positional and keyword calls give the same encoding, and written as
+    sorted-key JSON, which doesn't depend on the Python or pickle version.
+    """
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = {k: v for k, v in bound.arguments.items() if k not in ignore_args}
+    return json.dumps([func_name, arguments], sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+
+def make_cache_key(encoded_arguments):
+    """Create the cache key of the arguments encoded by encode_arguments, prefixed with CACHE_KEY_VERSION."""
+    return f"{CACHE_KEY_VERSION}:{hashlib.blake2b(encoded_arguments.encode(), digest_size=16).hexdigest()}"
 
 def serialize_arguments(*args, **kwargs):
-    """Serialize both list and non-list arguments for cache key creation."""
+    """Serialize both list and non-list arguments for legacy cache key creation."""
     def serialize(value):
         if isinstance(value, (list, dict)):
             return pickle.dumps(value)
@@ -19,17 +102,54 @@ def serialize_arguments(*args, **kwargs):
     return serialized_args, serialized_kwargs
 
 def generate_cache_key(func_name, serialized_args, serialized_kwargs):
-    """Create a unique cache key based on function name and serialized arguments."""
+    """Create the legacy (unversioned) cache key based on function name and serialized arguments."""
     key_parts = [func_name]
     key_parts.extend(serialized_args)
     key_parts.extend([f"{k}:{v}" for k, v in serialized_kwargs.items()])
     cache_key = hashlib.md5("".join(key_parts).encode()).hexdigest()
     return cache_key
 
-def cache_function(batch_mode=False, disable_cache=False):
-    """Decorator to handle caching of function results."""
+def load_legacy_cached(func_name, keyed_arguments):
+    """
+    Look up entries saved under legacy cache keys and copy them to their current keys.
+
+    :param func_name: Name of the cached function
+    :param keyed_arguments: List of (key, args, kwargs) tuples of the entries missing under their current key
+    :return: A dictionary of current key and result for the entries found
+    """
+    legacy_keys = {}
+    for key, args, kwargs in keyed_arguments:
+        kwargs = {k: v for k, v in kwargs.items() if k not in LEGACY_NEW_ARGS}
+        try:
+            legacy_keys[generate_cache_key(func_name, serialize_arguments(*args)[0], serialize_arguments(**kwargs)[1])] = key
+        except TypeError:
+            continue  # legacy keys can't be built for positional list arguments
+    legacy_found = {legacy_key: result for legacy_key, result in cache_db.load_many(list(legacy_keys)).items() if result}
+    found = {legacy_keys[legacy_key]: result for legacy_key, result in legacy_found.items()}
+    if found:
+        print(f"[Cache] Moved {len(found)} entries from legacy cache keys")
+        save_cached(found.items(), func_name)
+        cache_db.delete_cache(list(legacy_found))
+    return found
+
+def split_batch_arguments(args, kwargs, index):
+    """Return the args and kwargs of one item of a batch call, taking the index element of list arguments (lists of one element apply to all items)."""
+    item_args = [(arg[0] if len(arg) == 1 else arg[index]) if isinstance(arg, list) else arg for arg in args]
+    item_kwargs = {k: (v[0] if len(v) == 1 else v[index]) if isinstance(v, list) else v for k, v in kwargs.items()}
+    return item_args, item_kwargs
+
+def cache_function(batch_mode=False, disable_cache=False, ignore_args=('disable_cache',)):
+    """
+    Decorator to handle caching of function results.
+
+    :param batch_mode: Cache each element separately when the function is called with lists of arguments
+    :param disable_cache: Execute the function without loading or saving cache
+    :param ignore_args: Names of arguments that don't change the result and are left out of the cache key
+    """
     
     def decorator(func):
+        signature = inspect.signature(func)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             #print(f"\n[Cache] Function '{func.__name__}' called with args: {args}, kwargs: {kwargs}")
@@ -52,26 +172,19 @@ def cache_function(batch_mode=False, disable_cache=False):
                 cache_results = [None] * max_length
                 missing_indices = []
 
-                # Check cache for each index
-                for index in range(max_length):
-                    current_args = list(args)
-                    current_kwargs = kwargs.copy()
-
-                    # Update current_args for batch mode (split list elements)
-                    for i, arg in enumerate(current_args):
-                        if isinstance(arg, list):
-                            current_args[i] = arg[0] if len(arg) == 1 else arg[index]
-                    # Update current_kwargs for batch mode (split list elements)
-                    for k, v in current_kwargs.items():
-                        if isinstance(v, list):
-                            current_kwargs[k] = v[0] if len(v) == 1 else v[index]
-                    
-                    # Generate cache key for current index
-                    current_key = generate_cache_key(func.__name__,
-                        serialize_arguments(*current_args)[0],
-                        serialize_arguments(**current_kwargs)[1])
-
-                    cached_result = cache_db.load_cache(current_key)
+                # Split the arguments of each item and generate its cache key once, it is reused to save the result
+                items = [split_batch_arguments(args, kwargs, index) for index in range(max_length)]
+                encoded = [encode_arguments(func.__name__, signature, item_args, item_kwargs, ignore_args) for item_args, item_kwargs in items]
+                keys = [make_cache_key(item_encoded) for item_encoded in encoded]
+
+                # Check cache for all indices in a single database round trip
+                cached = load_cached(keys)
+                if config['cache'].get('legacy_keys'):
+                    missing = [(key, *items[index]) for index, key in enumerate(keys) if not cached.get(key)]
+                    if missing:
+                        cached.update(load_legacy_cached(func.__name__, missing))
+                for index, current_key in enumerate(keys):
+                    cached_result = cached.get(current_key)
                     if cached_result:
                         print(f"[Cache] Cache hit for query {index} (key: {current_key})")
                         cache_results[index] = cached_result
@@ -79,108 +192,96 @@ def cache_function(batch_mode=False, disable_cache=False):
                         print(f"[Cache] Cache miss for query {index} (key: {current_key}). Marking for execution.")
                         missing_indices.append(index)
 
-                # If there are cache misses, call the function for the missing inputs
+                # Claim the missing keys, those already being computed by another call (or earlier in this batch) are waited for
+                waiting = {}
                 if missing_indices:
-                    missing_args = list(args)
-                    missing_kwargs = kwargs.copy()
-
-                    for i in range(len(missing_args)):
-                        if isinstance(missing_args[i], list):
-                            missing_args[i] = [args[i][index] for index in missing_indices]
+                    owned = []
+                    for index in missing_indices:
+                        future, owner = in_flight.claim(keys[index])
+                        if not owner:
+                            waiting[index] = future
+                            continue
+                        cached_result = memory_cache.get(keys[index])  # saved by a call that ended since the lookup
+                        if cached_result:
+                            cache_results[index] = cached_result
+                            in_flight.resolve(keys[index], cached_result)
+                        else:
+                            owned.append(index)
+                    if waiting:
+                        print(f"[Cache] Waiting for the calls in flight for queries: {list(waiting)}")
+                    missing_indices = owned
 
-                    for k, v in missing_kwargs.items():
-                        if isinstance(v, list):
-                            missing_kwargs[k] = [kwargs[k][index] for index in missing_indices]
+                # If there are cache misses, call the function for the missing inputs
+                if missing_indices:
+                    missing_args = [[items[index][0][i] for index in missing_indices] if isinstance(arg, list) else arg for i, arg in enumerate(args)]
+                    missing_kwargs = {k: [items[index][1][k] for index in missing_indices] if isinstance(v, list) else v for k, v in kwargs.items()}
 
                     print(f"[Cache] Executing function for missing queries: {missing_indices}")
-                    missing_results = func(*missing_args, **missing_kwargs)
+                    try:
+                        missing_results = func(*missing_args, **missing_kwargs)
+                        to_save = []
 
-                    # Handle the results based on whether the function returns a tuple
-                    if isinstance(missing_results, tuple):
                         for i, index in enumerate(missing_indices):
-                            new_results = []
-                            for j, result_part in enumerate(missing_results):
-                                if new_results is None:
-                                    new_results = []
-                                new_results.append(result_part[i])
-                            cache_results[index] = tuple(new_results)
-
-                            current_args = list(args)
-                            current_kwargs = kwargs.copy()
-
-                            # Update current_args and current_kwargs for cache saving
-                            for k in range(len(current_args)):
-                                if isinstance(current_args[k], list):
-                                    current_args[k] = args[k][0] if len(args[k]) == 1 else args[k][index]
-                            for kwarg_key in current_kwargs:
-                                if isinstance(kwargs[kwarg_key], list):
-                                    current_kwargs[kwarg_key] = kwargs[kwarg_key][0] if len(kwargs[kwarg_key]) == 1 else kwargs[kwarg_key][index]
-                            
-                            current_key = generate_cache_key(func.__name__,
-                                serialize_arguments(*current_args)[0],
-                                serialize_arguments(**current_kwargs)[1])
-                            
-                            if 'error' in cache_results[index]:
-                                print(f"[Cache] Cache not saved because error keyword was found.")
+                            # Handle the results based on whether the function returns a tuple
+                            if isinstance(missing_results, tuple):
+                                cache_results[index] = tuple(result_part[i] if i < len(result_part) else None for result_part in missing_results)  # parts shorter than the batch, e.g. an empty history
                             else:
-                                print(f"[Cache] Saving tuple results to cache for query {index} (key: {current_key})")
-                                cache_db.save_cache(current_key, cache_results[index])
+                                cache_results[index] = missing_results[i]
 
-                        result = tuple([list(sum((item if isinstance(item, list) else [item] for item in group), [])) for group in zip(*cache_results)])
-                        return result
-                    else:
-                        # Handle single-result functions
-                        for i, index in enumerate(missing_indices):
-                            cache_results[index] = missing_results[i]
-                            current_args = list(args)
-                            current_kwargs = kwargs.copy()
-
-                            # Update current_args and current_kwargs for cache saving
-                            for k in range(len(current_args)):
-                                if isinstance(current_args[k], list):
-                                    current_args[k] = args[k][0] if len(args[k]) == 1 else args[k][index]
-                            for kwarg_key in current_kwargs:
-                                if isinstance(kwargs[kwarg_key], list):
-                                    current_kwargs[kwarg_key] = kwargs[kwarg_key][0] if len(kwargs[kwarg_key]) == 1 else kwargs[kwarg_key][index]
-
-                            current_key = generate_cache_key(func.__name__,
-                                serialize_arguments(*current_args)[0],
-                                serialize_arguments(**current_kwargs)[1])
-
-                            if 'error' in cache_results[index]:
+                            if has_error(cache_results[index]):
                                 print(f"[Cache] Cache not saved because error keyword was found.")
                             else:
-                                print(f"[Cache] Saving result to cache for query {index} (key: {current_key})")
-                                cache_db.save_cache(current_key, missing_results[i])
-                        result = tuple([list(sum((item if isinstance(item, list) else [item] for item in group), [])) for group in zip(*cache_results)])
-                        return result
-                else:
-                    result = tuple([list(sum((item if isinstance(item, list) else [item] for item in group), [])) for group in zip(*cache_results)])
-                    return result
+                                print(f"[Cache] Saving result to cache for query {index} (key: {keys[index]})")
+                                to_save.append((keys[index], cache_results[index]))
+
+                        save_cached(to_save, func.__name__, {keys[index]: encoded[index] for index in missing_indices})
+                    except BaseException as e:
+                        for index in missing_indices:
+                            in_flight.resolve(keys[index], error=e)
+                        raise
+                    for index in missing_indices:
+                        in_flight.resolve(keys[index], cache_results[index])
+
+                for index, future in waiting.items():
+                    cache_results[index] = future.result()
+
+                result = tuple(list(group) for group in zip(*cache_results))  # one element per item, so results stay aligned with the inputs
+                return result
             
             else: # handling load and save cache for functions that are no batch calls
                 
-                current_args = list(args)
-                current_kwargs = kwargs.copy()
-                
-                # Generate cache key for current index
-                single_cache_key = generate_cache_key(func.__name__,
-                    serialize_arguments(*current_args)[0],
-                    serialize_arguments(**current_kwargs)[1])
+                # Generate cache key for the call
+                single_encoded = encode_arguments(func.__name__, signature, args, kwargs, ignore_args)
+                single_cache_key = make_cache_key(single_encoded)
 
-                cached_result = cache_db.load_cache(single_cache_key)
+                cached_result = load_cached([single_cache_key]).get(single_cache_key)
+                if not cached_result and config['cache'].get('legacy_keys'):
+                    cached_result = load_legacy_cached(func.__name__, [(single_cache_key, args, kwargs)]).get(single_cache_key)
                 if cached_result:
                     print(f"[Cache] Cache hit for single query (key: {single_cache_key})")
                     return cached_result
-                else:
-                    print(f"[Cache] Cache miss for single query (key: {single_cache_key}). Executing function.")
+                future, owner = in_flight.claim(single_cache_key)
+                if not owner:
+                    print(f"[Cache] Cache miss for single query (key: {single_cache_key}). Waiting for the call in flight.")
+                    return future.result()
+                cached_result = memory_cache.get(single_cache_key)  # saved by a call that ended since the lookup
+                if cached_result:
+                    in_flight.resolve(single_cache_key, cached_result)
+                    return cached_result
+
+                print(f"[Cache] Cache miss for single query (key: {single_cache_key}). Executing function.")
+                try:
                     result = func(*args, **kwargs)
-                    if 'error' in result:
+                    if has_error(result):
                         print(f"[Cache] Cache not saved because error keyword was found.")
                     else:
                         print(f"[Cache] Saving result to cache for query (key: {single_cache_key})")
-                        cache_db.save_cache(single_cache_key, result)
-                    return result
+                        save_cached([(single_cache_key, result)], func.__name__, {single_cache_key: single_encoded})
+                except BaseException as e:
+                    in_flight.resolve(single_cache_key, error=e)
+                    raise
+                in_flight.resolve(single_cache_key, result)
+                return result
         
         return wrapper
     
@@ -1,86 +1,522 @@
+import json
 import sqlite3
-import pickle
+import threading
+import time
+from cache.codec import encode_value, decode_value, value_header, COMPRESSIONS
 
 class CacheDatabase:
-    def __init__(self, db_path="cache/cache.db"):
+    # Largest number of bound parameters used in a single statement (SQLite's default limit is 999)
+    MAX_VARIABLES = 900
+    # Number of saved entries after which the size limits are enforced again
+    EVICT_EVERY = 1000
+    # Accesses are recorded in memory and written once this many entries were read, or this many seconds passed
+    ACCESS_FLUSH_EVERY = 1000
+    ACCESS_FLUSH_SECONDS = 60
+    EVICTION_ORDER = {
+        'lru': 'accessed_at ASC',
+        'lfu': 'hits ASC, accessed_at ASC'
+    }
+
+    def __init__(self, db_path="cache/cache.db", ttl=None, max_entries=0, max_bytes=0, eviction_policy='lru', compression='zlib', full_text_index=True):
+        """
+        :param db_path: Path of the SQLite database file
+        :param ttl: Dictionary of function name and time to live in seconds of its entries (0 never expires), the 'default' entry applies to the other functions
+        :param max_entries: Maximum number of entries kept in the database (0 for no limit)
+        :param max_bytes: Maximum total size in bytes of the stored results (0 for no limit)
+        :param eviction_policy: 'lru' evicts the least recently accessed entries first, 'lfu' the least often accessed
+        :param compression: Compression of the stored JSON values: 'zlib', 'zstd' or 'none'
+        :param full_text_index: Index the text of the saved results, function names and query arguments for search_cache
+        """
+        if eviction_policy not in self.EVICTION_ORDER:
+            raise ValueError(f"Invalid eviction_policy '{eviction_policy}'. Use 'lru' or 'lfu'.")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Invalid compression '{compression}'. Use 'zlib', 'zstd' or 'none'.")
+        self.compression = compression
+        self.full_text_index = bool(full_text_index)
+        self.index_deletes = False  # whether rows can be deleted from the full text index, see _init_index
         self.db_path = db_path
+        self.ttl = {func_name: float(seconds or 0) for func_name, seconds in (ttl or {}).items()}
+        self.max_entries = int(max_entries or 0)
+        self.max_bytes = int(max_bytes or 0)
+        self.eviction_policy = eviction_policy
+        self._local = threading.local()
+        self._saved_since_eviction = 0
+        self._pending_access = {}  # key -> (last access time, number of accesses) not written yet
+        self._access_lock = threading.Lock()
+        self._access_flushed_at = time.time()
         self._init_db()
+        self.evict()
+
+    def _connection(self):
+        """Return the connection of the calling thread, opening and tuning it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')  # readers don't block the writer and vice versa
+            conn.execute('PRAGMA synchronous=NORMAL')  # safe with WAL, avoids an fsync per commit
+            conn.execute('PRAGMA cache_size=-65536')  # 64 MB page cache
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA mmap_size=268435456')  # 256 MB memory mapped reads
+            conn.execute('PRAGMA recursive_triggers=ON')  # INSERT OR REPLACE fires the delete trigger of the replaced row
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Write the pending accesses and close the connection of the calling thread."""
+        self.flush_access()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # Ids are never reused, so the full text index entries of deleted rows can't match the rows saved after them
+    CACHE_TABLE = '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE,
+            result BLOB,
+            func_name TEXT,
+            created_at REAL,
+            accessed_at REAL,
+            hits INTEGER DEFAULT 0
+        )
+    '''
 
     def _init_db(self):
-        """Initialize the cache table in the database if it doesn't exist."""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(''' 
-            CREATE TABLE IF NOT EXISTS cache ( 
-                id INTEGER PRIMARY KEY, 
-                key TEXT UNIQUE, 
-                result BLOB 
-            ) 
+        """Initialize the cache table in the database if it doesn't exist, adding the bookkeeping columns to older databases."""
+        conn = self._connection()
+        with conn:
+            existing = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'cache'").fetchone()
+            if existing is None:
+                conn.execute(self.CACHE_TABLE.format(table='cache'))
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(cache)')}
+            for column, definition in [('func_name', 'TEXT'), ('created_at', 'REAL'), ('accessed_at', 'REAL'), ('hits', 'INTEGER DEFAULT 0')]:
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE cache ADD COLUMN {column} {definition}')
+            if existing is not None and 'AUTOINCREMENT' not in existing[0].upper():
+                self._migrate_ids(conn)
+            # Entries saved before timestamps existed are treated as created now
+            now = time.time()
+            conn.execute('UPDATE cache SET created_at = ?, accessed_at = ? WHERE created_at IS NULL', (now, now))
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_func_name_created_at ON cache (func_name, created_at)')
+
+        if self.full_text_index:
+            try:
+                with conn:
+                    self._init_index(conn)
+            except sqlite3.OperationalError as e:
+                print(f"[Cache] Full text index disabled, SQLite FTS5 is not available: {e}")
+                self.full_text_index = False
+
+    def _migrate_ids(self, conn):
+        """
+        Recreate a cache table of a previous version, whose ids could be reused after a delete, with AUTOINCREMENT ids.
+
+        The rows keep their ids, so the full text index stays valid, and new ids start after the largest id of the cache
+        and of the index, whose entries of deleted rows may outlive them.
+        """
+        print("[Cache] Upgrading the cache table so the ids of deleted entries aren't reused")
+        conn.execute('DROP TABLE IF EXISTS cache_migrated')
+        conn.execute(self.CACHE_TABLE.format(table='cache_migrated'))
+        conn.execute('''
+            INSERT INTO cache_migrated (id, key, result, func_name, created_at, accessed_at, hits)
+            SELECT id, key, result, func_name, created_at, accessed_at, hits FROM cache
         ''')
-        conn.commit()
-        conn.close()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM cache').fetchone()[0]
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'cache_fts'").fetchone():
+            try:
+                last_index_row = conn.execute('SELECT rowid FROM cache_fts ORDER BY rowid DESC LIMIT 1').fetchone()
+                last_id = max(last_id, last_index_row[0] if last_index_row else 0)
+            except sqlite3.OperationalError:  # FTS5 is not available, the index isn't used
+                pass
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'cache_migrated'")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('cache_migrated', ?)", (last_id,))
+        conn.execute('DROP TRIGGER IF EXISTS cache_fts_delete')  # recreated on the new table by _init_index
+        conn.execute('DROP TABLE cache')
+        conn.execute('ALTER TABLE cache_migrated RENAME TO cache')
+
+    def _init_index(self, conn):
+        """
+        Create the full text index of the cache entries, its rowid is the id of the cache row.
+
+        The index is contentless, it stores the index alone and no copy of the (compressed) results. Rows are deleted from
+        it with the cache rows where SQLite supports contentless_delete (3.43+). With older versions the entries of
+        deleted rows stay in the index until it is rebuilt, searches leave them out by joining the cache table on its ids, which
+        are never reused.
+        """
+        existing = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'cache_fts'").fetchone()
+        if existing and "content=''" not in existing[0]:
+            # Indexes of previous versions stored the full text of every result and its arguments
+            conn.execute('DROP TRIGGER IF EXISTS cache_fts_delete')
+            conn.execute('DROP TABLE cache_fts')
+            print("[Cache] Full text index recreated without stored content, run 'python -m cache reindex' to index the existing entries")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS cache_fts USING fts5(func_name, query, content, content='', contentless_delete=1)")
+        except sqlite3.OperationalError:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS cache_fts USING fts5(func_name, query, content, content='')")
+        self.index_deletes = 'contentless_delete' in conn.execute("SELECT sql FROM sqlite_master WHERE name = 'cache_fts'").fetchone()[0]
+        if self.index_deletes:
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS cache_fts_delete AFTER DELETE ON cache BEGIN
+                    DELETE FROM cache_fts WHERE rowid = old.id;
+                END
+            ''')
+        else:
+            conn.execute('DROP TRIGGER IF EXISTS cache_fts_delete')
+
+    def ttl_of(self, func_name):
+        """Time to live of the entries of func_name, entries without a function name (saved before it was recorded) get the default one."""
+        if not func_name:
+            return self.ttl.get('default')
+        return self.ttl.get(func_name, self.ttl.get('default'))
+
+    def expires_at(self, func_name, created_at):
+        """Time an entry of func_name created at created_at expires, None when it never does."""
+        ttl = self.ttl_of(func_name)
+        if not ttl or created_at is None:
+            return None
+        return created_at + ttl
 
-    def save_cache(self, key, result):
+    def is_expired(self, func_name, created_at, now=None):
+        """Check whether an entry of func_name created at created_at is past its time to live."""
+        expires_at = self.expires_at(func_name, created_at)
+        return expires_at is not None and (now or time.time()) > expires_at
+
+    def save_cache(self, key, result, func_name=None, arguments=None):
         """Save a new cache entry or update an existing one."""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        self.save_many([(key, result)], func_name, {key: arguments} if arguments else None)
+
+    def save_many(self, items, func_name=None, arguments=None):
+        """
+        Save several cache entries in a single transaction.
+
+        :param items: A dictionary of key and result, or an iterable of (key, result) tuples
+        :param func_name: Name of the cached function, used to apply its time to live
+        :param arguments: Dictionary of key and the encoded arguments that produced it, their query text is added to the full text index
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        items = list(items)
+        now = time.time()
+        rows = [(key, encode_value(result, self.compression), func_name, now, now) for key, result in items]
+        if not rows:
+            return
+
+        conn = self._connection()
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO cache (key, result, func_name, created_at, accessed_at, hits) VALUES (?, ?, ?, ?, ?, 0)
+            ''', rows)
+            if self.full_text_index:
+                arguments = arguments or {}
+                conn.executemany('''
+                    INSERT INTO cache_fts (rowid, func_name, query, content) SELECT id, ?, ?, ? FROM cache WHERE key = ?
+                ''', [(func_name or '', self.query_text(arguments.get(key)), self.result_text(result), key) for key, result in items])
+
+        self._saved_since_eviction += len(rows)
+        if self._saved_since_eviction >= self.EVICT_EVERY:
+            self.evict()
 
-        # Serialize using pickle to preserve types, including dictionaries
-        serialized_result = pickle.dumps(result)
+    @staticmethod
+    def result_text(result):
+        """Text of a result as indexed for full text search."""
+        return result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
 
-        c.execute('''
-            INSERT OR REPLACE INTO cache (key, result) VALUES (?, ?)
-        ''', (key, serialized_result))
-        conn.commit()
-        conn.close()
+    @staticmethod
+    def query_text(arguments):
+        """
+        Text of the arguments of an entry as indexed for full text search: its string arguments, e.g. the query and role,
+        leaving out lists and dictionaries such as the chat history.
+
+        :param arguments: The function name and arguments encoded as JSON by encode_arguments
+        """
+        if not arguments:
+            return ''
+        try:
+            _, values = json.loads(arguments)
+        except (ValueError, TypeError):
+            return ''
+        return ' '.join(value for value in values.values() if isinstance(value, str)) if isinstance(values, dict) else ''
 
     def load_cache(self, key):
         """Load a cache entry based on the key."""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''
-            SELECT result FROM cache WHERE key = ?
-        ''', (key,))
-        row = c.fetchone()
-        conn.close()
-
-        if row:
-            # Deserialize with pickle
-            result = pickle.loads(row[0])
-            return result
-        return None
+        return self.load_many([key]).get(key)
+
+    def load_many(self, keys, expiry=None):
+        """
+        Load several cache entries at once.
+
+        :param keys: List of cache keys
+        :param expiry: Dictionary filled with the time each entry found expires, None for entries that never do
+        :return: A dictionary with the results of the keys found in the cache
+        """
+        keys = list(dict.fromkeys(keys))
+        conn = self._connection()
+        now = time.time()
+        results = {}
+        for start in range(0, len(keys), self.MAX_VARIABLES):
+            chunk = keys[start:start + self.MAX_VARIABLES]
+            rows = conn.execute('SELECT key, result, func_name, created_at FROM cache WHERE key IN ({seq})'.format(seq=','.join(['?'] * len(chunk))), chunk).fetchall()
+            for key, result, func_name, created_at in rows:
+                if self.is_expired(func_name, created_at, now):
+                    continue  # expired entries are reported as missing and replaced on the next save
+                try:
+                    results[key] = decode_value(result)
+                except Exception as e:  # e.g. zstd values without the zstandard package, or a corrupted row
+                    print(f"[Cache] Could not decode cache entry {key}, treated as missing: {e}")
+                    continue
+                if expiry is not None:
+                    expiry[key] = self.expires_at(func_name, created_at)
+
+        self.record_access(results, now)
+        return results
+
+    def record_access(self, keys, now=None):
+        """Record the access to entries for the eviction policy, written in batches by flush_access to keep reads free of writes."""
+        if not keys:
+            return
+        now = now or time.time()
+        with self._access_lock:
+            for key in keys:
+                hits = self._pending_access.get(key, (now, 0))[1]
+                self._pending_access[key] = (now, hits + 1)
+            flush = len(self._pending_access) >= self.ACCESS_FLUSH_EVERY or now - self._access_flushed_at >= self.ACCESS_FLUSH_SECONDS
+        if flush:
+            self.flush_access()
+
+    def flush_access(self):
+        """Write the recorded accesses, the access time and hits of each entry, in a single transaction."""
+        with self._access_lock:
+            pending = self._pending_access
+            self._pending_access = {}
+            self._access_flushed_at = time.time()
+        if not pending:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany('UPDATE cache SET accessed_at = MAX(COALESCE(accessed_at, 0), ?), hits = hits + ? WHERE key = ?',
+                             [(accessed_at, hits, key) for key, (accessed_at, hits) in pending.items()])
 
     def load_all_cache(self):
-        """Load all cache entries."""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT key, result FROM cache')
-        rows = c.fetchall()
-        conn.close()
-
-        all_cache = {}
-        for row in rows:
-            key = row[0]
-            result = pickle.loads(row[1])
-            all_cache[key] = result
-            
-        return all_cache
+        """Load all cache entries. Prefer iter_cache for large caches, this keeps every result in memory."""
+        return {entry['key']: entry['result'] for entry in self.iter_cache()}
+
+    def iter_cache(self, prefix=None, func_name=None, created_after=None, created_before=None, include_expired=True, decode=True, batch_size=500):
+        """
+        Stream cache entries in constant memory, reading batch_size rows at a time.
+
+        :param prefix: Only entries whose key starts with prefix
+        :param func_name: Only entries saved by this function
+        :param created_after: Only entries created at or after this timestamp (seconds since the epoch)
+        :param created_before: Only entries created before this timestamp (seconds since the epoch)
+        :param include_expired: Also return entries past their time to live
+        :param decode: Deserialize the results, with False 'result' holds the stored bytes
+        :param batch_size: Number of rows fetched from the database at a time
+        :return: Generator of dictionaries with the key, func_name, created_at, accessed_at, hits and result of each entry
+        """
+        conditions = []
+        params = []
+        if prefix:
+            conditions.append('key >= ? AND key < ?')
+            params.extend([prefix, prefix + '\U0010ffff'])
+        if func_name:
+            conditions.append('func_name = ?')
+            params.append(func_name)
+        if created_after is not None:
+            conditions.append('created_at >= ?')
+            params.append(created_after)
+        if created_before is not None:
+            conditions.append('created_at < ?')
+            params.append(created_before)
+        sql = 'SELECT key, func_name, created_at, accessed_at, hits, result FROM cache'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        # A dedicated connection keeps the read snapshot independent from writes made while iterating
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            cursor = conn.execute(sql, params)
+            now = time.time()
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for key, name, created_at, accessed_at, hits, result in rows:
+                    if not include_expired and self.is_expired(name, created_at, now):
+                        continue
+                    yield {'key': key, 'func_name': name, 'created_at': created_at, 'accessed_at': accessed_at, 'hits': hits,
+                           'result': decode_value(result) if decode else result}
+        finally:
+            conn.close()
 
     def delete_cache(self, keys):
         """Delete specific cache entries by keys."""
         if not keys:  # Check if the keys list is empty
             return
 
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        # Prepare the SQL statement for deleting by keys
-        c.execute('DELETE FROM cache WHERE key IN ({seq})'.format(seq=','.join(['?'] * len(keys))), keys)
-        
-        conn.commit()  # Ensure changes are committed
-        conn.close()
+        keys = list(keys)
+        conn = self._connection()
+        with conn:
+            # Prepare the SQL statement for deleting by keys
+            for start in range(0, len(keys), self.MAX_VARIABLES):
+                chunk = keys[start:start + self.MAX_VARIABLES]
+                conn.execute('DELETE FROM cache WHERE key IN ({seq})'.format(seq=','.join(['?'] * len(chunk))), chunk)
 
-    def search_partial_match(self, dictionary, search_term):
-        """Search for a partial match in the cache database."""
-        return {key: value for key, value in dictionary.items() if search_term in str(value)}
+    def delete_expired(self):
+        """Delete the entries that are past the time to live of their function. Returns the number of deleted entries."""
+        now = time.time()
+        deleted = 0
+        conn = self._connection()
+        functions = [func_name for func_name in self.ttl if func_name != 'default']
+        with conn:
+            for func_name in functions:
+                if self.ttl[func_name]:
+                    deleted += conn.execute('DELETE FROM cache WHERE func_name = ? AND created_at < ?', (func_name, now - self.ttl[func_name])).rowcount
+            if self.ttl.get('default'):  # also entries without a function name, saved before it was recorded
+                deleted += conn.execute('DELETE FROM cache WHERE (func_name IS NULL OR func_name NOT IN ({seq})) AND created_at < ?'.format(seq=','.join(['?'] * len(functions))), functions + [now - self.ttl['default']]).rowcount
+        return deleted
+
+    def evict(self):
+        """
+        Delete expired entries and then evict entries, following the eviction policy, until the size limits are met.
+
+        :return: The number of deleted entries
+        """
+        self._saved_since_eviction = 0
+        self.flush_access()  # the eviction order depends on the accesses
+        deleted = self.delete_expired()
+        order = self.EVICTION_ORDER[self.eviction_policy]
+        conn = self._connection()
+
+        if self.max_entries:
+            excess = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_entries
+            if excess > 0:
+                with conn:
+                    deleted += conn.execute(f'DELETE FROM cache WHERE id IN (SELECT id FROM cache ORDER BY {order} LIMIT ?)', (excess,)).rowcount
+
+        if self.max_bytes:
+            stored, count = conn.execute('SELECT SUM(LENGTH(result)), COUNT(*) FROM cache').fetchone()
+            index_bytes = self.index_stats()['bytes']
+            excess = (stored or 0) + index_bytes - self.max_bytes
+            if excess > 0:
+                row_index_bytes = index_bytes / count if count else 0  # share of the index freed with each row
+                ids = []
+                for row_id, size in conn.execute(f'SELECT id, LENGTH(result) FROM cache ORDER BY {order}'):
+                    ids.append(row_id)
+                    excess -= size + row_index_bytes
+                    if excess <= 0:
+                        break
+                with conn:
+                    for start in range(0, len(ids), self.MAX_VARIABLES):
+                        chunk = ids[start:start + self.MAX_VARIABLES]
+                        deleted += conn.execute('DELETE FROM cache WHERE id IN ({seq})'.format(seq=','.join(['?'] * len(chunk))), chunk).rowcount
 
+        if deleted:
+            print(f"[Cache] Evicted {deleted} cache entries")
+        return deleted
+
+    def compact(self):
+        """Evict expired and excess entries, merge the full text index, then rebuild the database file to reclaim the freed space."""
+        deleted = self.evict()
+        conn = self._connection()
+        if self.full_text_index:
+            with conn:
+                conn.execute("INSERT INTO cache_fts (cache_fts) VALUES ('optimize')")
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('VACUUM')
+        return deleted
+
+    def search_cache(self, query, limit=50, offset=0, func_name=None):
+        """
+        Search the full text index of the cache, best matches first.
+
+        :param query: FTS5 query, e.g. 'child labour' (both words), '"child labour"' (phrase) or 'content: child*'
+        :param limit: Maximum number of entries returned
+        :param offset: Number of matching entries skipped, for pagination
+        :param func_name: Only return entries of this function
+        :return: List of dictionaries with the key, func_name and result of the matching entries
+        """
+        if not self.full_text_index:
+            raise RuntimeError("The full text index is disabled")
+        sql = 'SELECT c.key, c.func_name, c.result FROM cache_fts JOIN cache c ON c.id = cache_fts.rowid WHERE cache_fts MATCH ?'
+        params = [query]
+        if func_name:
+            sql += ' AND c.func_name = ?'
+            params.append(func_name)
+        sql += ' ORDER BY rank LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+        rows = self._connection().execute(sql, params).fetchall()
+        return [{'key': key, 'func_name': name, 'result': decode_value(result)} for key, name, result in rows]
+
+    def rebuild_index(self, batch_size=1000):
+        """
+        Rebuild the full text index from the stored results, e.g. for entries saved before the index existed, also
+        dropping the entries of deleted rows. The query text of the entries isn't stored, so only their function name
+        and results are indexed again. Returns the number of indexed entries.
+        """
+        if not self.full_text_index:
+            raise RuntimeError("The full text index is disabled")
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT INTO cache_fts (cache_fts) VALUES ('delete-all')")
+        last_id = 0
+        indexed = 0
+        while True:
+            rows = conn.execute('SELECT id, func_name, result FROM cache WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            with conn:
+                conn.executemany('INSERT INTO cache_fts (rowid, func_name, query, content) VALUES (?, ?, ?, ?)',
+                                 [(row_id, name or '', '', self.result_text(decode_value(result))) for row_id, name, result in rows])
+            indexed += len(rows)
+        return indexed
+
+    def migrate_values(self, batch_size=1000):
+        """
+        Rewrite the stored values that aren't encoded with the current codec, e.g. legacy pickle rows, in batches.
+
+        :param batch_size: Number of rows read and rewritten per transaction
+        :return: The number of rewritten rows
+        """
+        header = value_header(self.compression)
+        conn = self._connection()
+        last_id = 0
+        migrated = 0
+        while True:
+            rows = conn.execute('SELECT id, result FROM cache WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = [(encode_value(decode_value(result), self.compression), row_id) for row_id, result in rows if bytes(result[:1]) != header]
+            if updates:
+                with conn:
+                    conn.executemany('UPDATE cache SET result = ? WHERE id = ?', updates)
+                migrated += len(updates)
+                print(f"[Cache] Migrated {migrated} cache values")
+        return migrated
+
+    def index_stats(self):
+        """Return the number of entries and the size in bytes of the full text index."""
+        if not self.full_text_index:
+            return {'entries': 0, 'bytes': 0}
+        conn = self._connection()
+        size = conn.execute('SELECT COALESCE(SUM(LENGTH(block)), 0) FROM cache_fts_data').fetchone()[0]
+        size += conn.execute('SELECT COALESCE(SUM(LENGTH(sz)), 0) FROM cache_fts_docsize').fetchone()[0]
+        entries = conn.execute('SELECT COUNT(*) FROM cache_fts_docsize').fetchone()[0]
+        return {'entries': entries, 'bytes': size}
+
+    def stats(self):
+        """Return the number of entries and the total size of the stored results, per function, and of the full text index under 'full_text_index'."""
+        conn = self._connection()
+        rows = conn.execute('SELECT func_name, COUNT(*), SUM(LENGTH(result)) FROM cache GROUP BY func_name').fetchall()
+        stats = {func_name: {'entries': entries, 'bytes': size or 0} for func_name, entries, size in rows}
+        if self.full_text_index:
+            stats['full_text_index'] = self.index_stats()
+        return stats
+
+    def search_partial_match(self, dictionary, search_term):
+        """Search for a partial match in the cache database. Prefer search_cache, which uses the full text index."""
+        entries = dictionary.items() if isinstance(dictionary, dict) else ((entry['key'], entry['result']) for entry in dictionary)
+        return {key: value for key, value in entries if search_term in str(value)}
@@ -0,0 +1,93 @@
+import io
+import json
+import pickle
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional dependency, zlib is used when it isn't installed
+    zstandard = None
+
+# Header byte written in front of every stored value
+JSON = b'J'  # uncompressed JSON
+JSON_ZLIB = b'Z'  # zlib compressed JSON
+JSON_ZSTD = b'S'  # zstandard compressed JSON
+PICKLE = b'P'  # zlib compressed pickle, only for values JSON can't represent
+LEGACY_PICKLE = b'\x80'  # rows saved before the codec existed start with the pickle protocol marker
+
+COMPRESSIONS = ('none', 'zlib', 'zstd')
+
+# Globals legacy pickle rows may reference, anything else is refused instead of executed
+SAFE_PICKLE_GLOBALS = {
+    ('builtins', 'set'),
+    ('builtins', 'frozenset'),
+    ('builtins', 'bytearray'),
+    ('builtins', 'complex'),
+    ('collections', 'OrderedDict')
+}
+
+class SafeUnpickler(pickle.Unpickler):
+    """Unpickler restricted to plain data, so reading the cache never runs arbitrary code."""
+    def find_class(self, module, name):
+        if (module, name) in SAFE_PICKLE_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from the cache")
+
+def _tag_tuples(value):
+    """Replace tuples, which JSON would turn into lists, by tagged dictionaries."""
+    if isinstance(value, tuple):
+        return {'__tuple__': [_tag_tuples(item) for item in value]}
+    if isinstance(value, list):
+        return [_tag_tuples(item) for item in value]
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise TypeError("JSON only keeps string dictionary keys")
+        return {k: _tag_tuples(v) for k, v in value.items()}
+    return value
+
+def _untag_tuples(obj):
+    if len(obj) == 1 and '__tuple__' in obj:
+        return tuple(obj['__tuple__'])
+    return obj
+
+def encode_value(value, compression='zlib'):
+    """
+    Serialize a cached result into a header byte followed by its compressed JSON encoding.
+
+    :param value: The result to be stored
+    :param compression: 'zlib', 'zstd' (falls back to zlib when zstandard isn't installed) or 'none'
+    :return: The bytes to be stored in the database
+    """
+    try:
+        data = json.dumps(_tag_tuples(value), separators=(',', ':'), ensure_ascii=False, allow_nan=False).encode()
+    except (TypeError, ValueError):
+        return PICKLE + zlib.compress(pickle.dumps(value))
+    if compression == 'zstd' and zstandard is not None:
+        return JSON_ZSTD + zstandard.ZstdCompressor().compress(data)
+    if compression == 'none':
+        return JSON + data
+    return JSON_ZLIB + zlib.compress(data)
+
+def decode_value(data):
+    """Deserialize a stored result, whichever codec (or legacy pickle) it was saved with."""
+    data = bytes(data)
+    header, payload = data[:1], data[1:]
+    if header == JSON_ZLIB:
+        return json.loads(zlib.decompress(payload), object_hook=_untag_tuples)
+    if header == JSON_ZSTD:
+        if zstandard is None:
+            raise ValueError("The cache entry is compressed with zstandard, which isn't installed")
+        return json.loads(zstandard.ZstdDecompressor().decompress(payload), object_hook=_untag_tuples)
+    if header == JSON:
+        return json.loads(payload, object_hook=_untag_tuples)
+    if header == PICKLE:
+        return SafeUnpickler(io.BytesIO(zlib.decompress(payload))).load()
+    if header == LEGACY_PICKLE:
+        return SafeUnpickler(io.BytesIO(data)).load()
+    raise ValueError(f"Unknown cache value header {header!r}")
+
+def value_header(compression='zlib'):
+    """Header byte written by encode_value for JSON values with the given compression."""
+    if compression == 'zstd' and zstandard is not None:
+        return JSON_ZSTD
+    return JSON if compression == 'none' else JSON_ZLIB
@@ -0,0 +1,33 @@
+import threading
+from concurrent.futures import Future
+
+class InFlightCalls:
+    """
+    Calls in progress by cache key, so concurrent cache misses for the same key make a single call (single flight).
+
+    The first caller missing a key claims it and makes the call, callers missing the same key meanwhile wait for its
+    future. Errors are passed on to the waiting callers and nothing is kept once the call ends, so a failed call is
+    made again by the next caller.
+    """
+    def __init__(self):
+        self.calls = {}  # key -> future of the call in progress
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        """Return the future of the call for key and whether the caller owns it, i.e. must make the call and resolve it."""
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self.calls[key] = future
+            return future, True
+
+    def resolve(self, key, result=None, error=None):
+        """Pass the result, or the exception, of an owned call to the callers waiting for it and forget the call."""
+        with self.lock:
+            future = self.calls.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
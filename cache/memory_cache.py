@@ -0,0 +1,80 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+def estimate_size(value):
+    """Estimate the memory used by a result made of dictionaries, lists, tuples and scalars."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+class MemoryCache:
+    """
+    Bounded in-process LRU cache holding deserialized results in front of the cache database.
+
+    Entries are evicted, least recently used first, once either max_entries or max_bytes is exceeded, and dropped once
+    past the expiry time they were stored with, like their database rows.
+    Cached values are shared between callers, so they must not be mutated.
+    """
+    def __init__(self, max_entries=10000, max_bytes=268435456):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.entries = OrderedDict()  # key -> (value, size, expiry time or None)
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None when it isn't in memory."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and time.time() > entry[2]:
+                self.size_bytes -= self.entries.pop(key)[1]  # expired
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, expires_at=None):
+        """Store value under key until expires_at (None never expires), evicting the least recently used entries when over the limits."""
+        if self.max_entries <= 0:
+            return
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return  # never let a single entry flush the whole cache
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size, expires_at)
+            self.size_bytes += size
+            while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, keys):
+        """Drop keys from memory, e.g. after they were deleted from the database."""
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size_bytes -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        """Return the hit, miss and eviction counters along with the current size."""
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
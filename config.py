@@ -13,15 +13,52 @@ config = {
     'default_number_of_results': '10', # Default number of results in search queries
     'default_search_period': 'y1', # Default serach period
     'default_disable_cache': 'false', # Disable cache load and save
+    'search_max_workers': '8', # maximum number of search requests in flight at once (1 runs searches sequentially)
+    'max_parallel_queries': '4', # maximum number of queries (titles) processed at once, each one starting as soon as the queries it depends on are solved (1 runs them one after another)
     
+    # Cache settings
+    'cache': {
+        'memory_max_entries': '10000', # maximum number of results kept in the in-memory cache tier (0 disables it)
+        'memory_max_bytes': '268435456', # maximum estimated size in bytes of the in-memory cache tier (256 MB)
+        'ttl': { # time to live in seconds of the cached results of each function (0 never expires), 'default' applies to any other entry
+            'perform_search': '86400',
+            'ai_query': '0',
+            'default': '0'
+        },
+        'max_entries': '0', # maximum number of entries in the cache database (0 for no limit)
+        'max_bytes': '1073741824', # maximum total size in bytes of the results in the cache database (1 GB, 0 for no limit)
+        'legacy_keys': 'true', # look up entries saved under the cache keys of previous versions and move them to the current keys
+        'eviction_policy': 'lru', # entries evicted first when over the limits: 'lru' least recently used, 'lfu' least frequently used
+        'full_text_index': 'true', # index the text of the cached results and their queries for python -m cache search (the index stores no copy of the results)
+        'compression': 'zlib' # compression of the stored JSON values: 'zlib', 'zstd' (requires the zstandard package) or 'none'
+    },
+
     'llm_batch_process': 'true', # enable llm batch process request
-    'batch_sleep':'30', # sleep time in seconds to check for batch results
+    'llm_realtime_max_workers': '8', # maximum number of realtime llm requests in flight at once when llm_batch_process is disabled (1 sends them one after another)
+    'llm_max_prompt_tokens': '100000', # prompts over this many tokens are sent as one request per chunk of their largest list variable, results merged (0 disables)
+    'batch_sleep':'30', # maximum sleep time in seconds between checks for batch results
+    'batch_poll_min': '5', # initial sleep time in seconds between checks for batch results, it grows up to batch_sleep while a job makes no progress
+    'batch_max_requests': '50000', # maximum number of requests per batch job, larger batches are split into several jobs
+    'batch_max_bytes': '190000000', # maximum size in bytes of the request file of a batch job (the Batch API allows 200 MB)
+    'batch_max_parallel_jobs': '8', # maximum number of batch jobs uploaded and followed at once
+
+    # Shared HTTP transport used by search engines and AI services
+    'http': {
+        'pool_connections': '10', # number of hosts kept in the connection pool
+        'pool_maxsize': '20', # connections kept alive per host
+        'max_retries': '3', # retries on connection errors and 429/5xx responses
+        'backoff_factor': '1', # base delay in seconds for the jittered exponential backoff
+        'backoff_max': '60', # maximum delay in seconds between retries
+        'timeout': '60' # request timeout in seconds
+    },
 
     # AI Service API keys loaded from environment variables
     'ai_services': {
         'gpt': {
             'api_key': os.getenv('GPT_API_KEY'),
-            'model': 'gpt-4o-mini' # gpt-4o, gpt-4o-mini (required to structured output)
+            'model': 'gpt-4o-mini', # gpt-4o, gpt-4o-mini (required to structured output)
+            'rpm': '500', # requests per minute of realtime calls, replaced by the account limits reported in the response headers
+            'tpm': '200000' # tokens per minute of realtime calls, replaced by the account limits reported in the response headers
         },
         'azure': {
             'api_key': os.getenv('AZURE_API_KEY'),
@@ -49,10 +86,18 @@ config = {
     'search_engines': {
         'google': {
             'api_key': os.getenv('GOOGLE_SEARCH_API_KEY'),
-            'search_engine_id': os.getenv('GOOGLE_SEARCH_CX')  # Google Custom Search Engine ID
+            'search_engine_id': os.getenv('GOOGLE_SEARCH_CX'),  # Google Custom Search Engine ID
+            'qps': '1.5', # maximum requests per second (Google Custom Search allows 100 queries per minute by default)
+            'burst': '10', # requests let through at once before qps applies, so the result pages of a search can be fetched together
+            'daily_quota': '100', # maximum requests per day, counted across runs in data/api_quota.json (100 free queries per day, raise it when billing is enabled, 0 for no limit)
+            'quota_timezone': 'America/Los_Angeles', # timezone of the midnight when the daily quota resets
+            'parallel_pages': 'true' # fetch all result pages of a search concurrently instead of one after another, bounded by qps and burst
         },
         'bing': {
-            'api_key': os.getenv('BING_SEARCH_API_KEY')
+            'api_key': os.getenv('BING_SEARCH_API_KEY'),
+            'qps': '3', # maximum requests per second (Bing free tier allows 3 transactions per second)
+            'daily_quota': '0', # maximum requests per day, counted across runs in data/api_quota.json (0 for no limit)
+            'quota_timezone': 'UTC' # timezone of the midnight when the daily quota resets
         }
     },
 
@@ -1,13 +1,20 @@
 __version__ = "1.0.2"
 
+import argparse
 from config import config
 from ai_utils.ai_services import ai_query
 from search_utils.search_engine import perform_search
 from io_utils.io_services import io_service
 from utils.utils import utils
 from utils.query_processor import QueryProcessor
+from search_utils.search_limits import search_rate_limiter
+from cache.cache import memory_cache
 
 def main():
+    parser = argparse.ArgumentParser(description='Run the search and llm queries defined in the input sheets')
+    parser.add_argument('--resume', action='store_true', help='Restore the queries solved by the last interrupted run from their checkpoints instead of solving them again')
+    parser.add_argument('--incremental', action='store_true', help='Reuse the results of the last run for the prepared queries whose definition and variable values did not change')
+    args = parser.parse_args()
     
     # Read user defined inputs
     inputs = io_service.get_value('inputs', output_mode='list_dict_column')
@@ -18,11 +25,27 @@ def main():
     search_queries = io_service.get_value('search_queries', output_mode='list_dict')
     
     # initialize processor class
-    processor = QueryProcessor(inputs, llm_queries, search_queries, config)
+    processor = QueryProcessor(inputs, llm_queries, search_queries, config, resume=args.resume, incremental=args.incremental)
+
+    # Compare the search calls the queries need with the daily quotas left
+    search_calls, unknown_searches = processor.estimate_search_calls()
+    for search_service, calls in search_calls.items():
+        remaining = search_rate_limiter(search_service).remaining()
+        if remaining is None:
+            print(f"[Search Quota] {search_service}: up to {calls} calls needed, no daily quota set")
+        else:
+            print(f"[Search Quota] {search_service}: up to {calls} calls needed, {remaining} left in today's quota")
+            if calls > remaining:
+                print(f"[Search Quota] Warning: the {search_service} quota may run out, searches beyond it return no results and aren't cached")
+    if unknown_searches:
+        print(f"[Search Quota] Calls of {unknown_searches} depend on llm results and aren't included")
+
     query_results = processor.process_queries()
 
     # Save all query results to the same Excel file
     io_service.save_to_excel('data/query_results.xlsx', query_results)
+    processor.checkpoints.clear() # the run is complete, the next one starts from scratch
+    print(f"[Cache] In-memory cache stats: {memory_cache.stats()}")
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,8 @@
 # Bing Search API integration
-import requests
 from config import config
+from utils.rate_limiter import QuotaExceededError
+from search_utils.search_limits import search_rate_limiter
+from utils.http_client import http_client
 import warnings
 
 def perform_bing_search(search_query, exactTerms, orTerms, num_results, dateRestrict):
@@ -30,7 +32,13 @@ def perform_bing_search(search_query, exactTerms, orTerms, num_results, dateRest
             'count': min(50, num_results)
         }
 
-    response = requests.get(endpoint, headers=headers, params=params)
+    rate_limiter = search_rate_limiter('bing')
+    try:
+        rate_limiter.acquire()
+        response = http_client.get(endpoint, rate_limiter, headers=headers, params=params)
+    except QuotaExceededError as e:
+        warnings.warn(str(e), UserWarning)
+        return {'error': str(e)}  # Return error in a format that won't be cached
 
     error_messages = {
         400: "Bad request to Bing API.",
@@ -41,8 +49,9 @@ def perform_bing_search(search_query, exactTerms, orTerms, num_results, dateRest
     }
 
     if response.status_code in error_messages:
-        warnings.warn(f"{error_messages[response.status_code]} Status code: {response.status_code}", UserWarning)
-        return all_results
+        error_message = f"{error_messages[response.status_code]} Status code: {response.status_code}"
+        warnings.warn(error_message, UserWarning)
+        return {'error': error_message}  # Return error in a format that won't be cached
 
     search_results = response.json().get('webPages', {}).get('value', [])
 
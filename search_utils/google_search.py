@@ -1,6 +1,10 @@
 # Google Custom Search API integration
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from config import config
+from utils.rate_limiter import QuotaExceededError
+from search_utils.search_limits import search_rate_limiter
+from utils.http_client import http_client
 import warnings
 
 #search_query = out['search_query']
@@ -11,6 +15,28 @@ import warnings
 
 #https://console.cloud.google.com/apis/api/customsearch.googleapis.com/quotas?project=searchandprocess
 
+#https://cloud.google.com/storage/docs/json_api/v1/status-codes
+error_messages = {
+    400: "Bad request to Google API.",
+    401: "Unauthorized access to Google API.",
+    403: "Forbidden access to Google API.",
+    404: "Google API endpoint not found.",
+    405: "Method not allowed for Google API request.",
+    408: "Request timeout for Google API.",
+    409: "Conflict in Google API request.",
+    410: "Google API resource is gone.",
+    411: "Length required for Google API request.",
+    412: "Precondition failed for Google API request.",
+    413: "Payload too large for Google API request.",
+    416: "Requested range not satisfiable for Google API.",
+    429: "Too Many Requests. Google API quota may have been exceeded.",
+    499: "Client closed request to Google API.",
+    500: "Internal server error in Google API.",
+    502: "Bad gateway error from Google API.",
+    503: "Google API service unavailable.",
+    504: "Gateway timeout from Google API."
+}
+
 def perform_google_search(search_query, exactTerms, orTerms, num_results, dateRestrict):
     # Limit num_results to 100
     if num_results > 100:
@@ -20,70 +46,75 @@ def perform_google_search(search_query, exactTerms, orTerms, num_results, dateRe
     api_key = config['search_engines']['google']['api_key']
     search_engine_id = config['search_engines']['google']['search_engine_id']
     url = 'https://www.googleapis.com/customsearch/v1'
+    rate_limiter = search_rate_limiter('google')
     all_results = []
 
     #https://developers.google.com/custom-search/v1/reference/rest/v1/cse/list
     #siteSearch = config['search_engines']['google']['siteSearch']
     #siteSearchFilter = config['search_engines']['google']['siteSearchFilter']
 
-    for start_index in range(1, num_results + 1, 10):
-        params = {
-            'q': search_query,
-            'exactTerms': [exactTerms],
-            'orTerms': [orTerms],
-            'key': api_key,
-            'cx': search_engine_id,
-            'start': start_index,
-            'num': min(10, num_results - start_index + 1),
-            'dateRestrict': dateRestrict
-        }
-
-        response = requests.get(url, params=params)
-        #https://cloud.google.com/storage/docs/json_api/v1/status-codes
-        
-        error_messages = {
-            400: "Bad request to Google API.",
-            401: "Unauthorized access to Google API.",
-            403: "Forbidden access to Google API.",
-            404: "Google API endpoint not found.",
-            405: "Method not allowed for Google API request.",
-            408: "Request timeout for Google API.",
-            409: "Conflict in Google API request.",
-            410: "Google API resource is gone.",
-            411: "Length required for Google API request.",
-            412: "Precondition failed for Google API request.",
-            413: "Payload too large for Google API request.",
-            416: "Requested range not satisfiable for Google API.",
-            429: "Too Many Requests. Google API quota may have been exceeded.",
-            499: "Client closed request to Google API.",
-            500: "Internal server error in Google API.",
-            502: "Bad gateway error from Google API.",
-            503: "Google API service unavailable.",
-            504: "Gateway timeout from Google API."
-        }
-        if response.status_code in error_messages:
-            error_message = f"{error_messages[response.status_code]} Status code: {response.status_code}"
-            warnings.warn(error_message, UserWarning)
-            return {'error': error_message}  # Return error in a format that won't be cached
-        
-        print(f"[Google Search] Performing search for: {params['q']}, exactTerms: {params['exactTerms']}, orTerms: {params['orTerms']}") # Log the search parameters
-            
-        search_results = response.json().get('items', [])
-        
-        if not search_results:
-            error_message = "No search results found. There might be an error in the formulation of the search query."
-            warnings.warn(error_message, UserWarning)
-            return {'error': error_message}  # Return error in a format that won't be cached
-
-        all_results.extend([{
-            'title': item['title'],
-            'displayLink': item['displayLink'],
-            'link': item['link'],
-            'snippet': item.get('pagemap', {}).get('metatags', [{}])[0].get('og:description', item['snippet'])
-        } for item in search_results])
-
-        if len(search_results) < 10:
-            break
+    pages = [{
+        'q': search_query,
+        'exactTerms': [exactTerms],
+        'orTerms': [orTerms],
+        'key': api_key,
+        'cx': search_engine_id,
+        'start': start_index,
+        'num': min(10, num_results - start_index + 1),
+        'dateRestrict': dateRestrict
+    } for start_index in range(1, num_results + 1, 10)]
 
-    return all_results[:num_results]
+    print(f"[Google Search] Performing search for: {search_query}, exactTerms: {[exactTerms]}, orTerms: {[orTerms]}") # Log the search parameters
+
+    stop = threading.Event() # set once a page shows that no further pages are needed
+
+    def fetch_page(params):
+        # pages no longer needed are dropped without using a token or the daily quota
+        if stop.is_set() or not rate_limiter.acquire(cancelled=stop.is_set):
+            return None
+        return http_client.get(url, rate_limiter, params=params)
+
+    if config['search_engines']['google'].get('parallel_pages') and len(pages) > 1:
+        # Fetch all pages at once and read them back in rank order
+        executor = ThreadPoolExecutor(max_workers=len(pages))
+        responses = [executor.submit(fetch_page, params) for params in pages]
+    else:
+        executor = None
+        responses = (fetch_page(params) for params in pages)
+
+    try:
+        for response in responses:
+            if executor:
+                response = response.result()
 
+            if response.status_code in error_messages:
+                error_message = f"{error_messages[response.status_code]} Status code: {response.status_code}"
+                warnings.warn(error_message, UserWarning)
+                return {'error': error_message}  # Return error in a format that won't be cached
+
+            search_results = response.json().get('items', [])
+
+            if not search_results:
+                error_message = "No search results found. There might be an error in the formulation of the search query."
+                warnings.warn(error_message, UserWarning)
+                return {'error': error_message}  # Return error in a format that won't be cached
+
+            all_results.extend([{
+                'title': item['title'],
+                'displayLink': item['displayLink'],
+                'link': item['link'],
+                'snippet': item.get('pagemap', {}).get('metatags', [{}])[0].get('og:description', item['snippet'])
+            } for item in search_results])
+
+            if len(search_results) < 10:
+                break
+    except QuotaExceededError as e:
+        warnings.warn(str(e), UserWarning)
+        return {'error': str(e)}  # Return error in a format that won't be cached
+    finally:
+        # Cancel the pages that are still waiting, they are past the last result or after an error
+        stop.set()
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return all_results[:num_results]
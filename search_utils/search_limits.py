@@ -0,0 +1,8 @@
+# Rate limits and daily quotas of the search engines
+from config import config
+from utils.rate_limiter import get_rate_limiter
+
+def search_rate_limiter(search_service):
+    """Return the rate limiter shared by all calls to a search engine, with the QPS, burst and daily quota of its settings."""
+    settings = config['search_engines'][search_service]
+    return get_rate_limiter(search_service, settings.get('qps'), burst=settings.get('burst'), daily_quota=settings.get('daily_quota'), quota_timezone=settings.get('quota_timezone'))
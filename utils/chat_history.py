@@ -0,0 +1,75 @@
+def chat_messages(chat):
+    """Messages of a chat history entry, which holds either a single message or the list of messages of a call."""
+    return chat if isinstance(chat, list) else [chat]
+
+class ChatHistoryIndex:
+    """
+    Chat history entries of the queries a query depends on, indexed by the input and group values they were made with.
+
+    Messages are deduplicated by role and content once, as the entries are added, and each entry is listed under every
+    (variable, value) pair it has, so filtering only visits the entries sharing the values of the filter.
+    """
+    def __init__(self, entries=()):
+        self.entries = []  # the entries as added, used for the filters that can't be looked up
+        self.entry_messages = []  # ids of the messages of each entry
+        self.messages = []  # unique messages, by id
+        self.message_ids = {}  # (role, content) -> message id
+        self.postings = {}  # (variable, value) -> indexes of the entries with that value, in insertion order
+        self.posting_sets = {}
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        """Add a chat history entry, a dictionary of the variable values of the call and its 'chat_history'."""
+        index = len(self.entries)
+        ids = []
+        for message in chat_messages(entry['chat_history']):
+            pair = (message['role'], message['content'])
+            if pair not in self.message_ids:
+                self.message_ids[pair] = len(self.messages)
+                self.messages.append(message)
+            ids.append(self.message_ids[pair])
+        self.entries.append(entry)
+        self.entry_messages.append(ids)
+        for key, value in entry.items():
+            if key == 'chat_history':
+                continue
+            try:
+                self.postings.setdefault((key, value), []).append(index)
+            except TypeError:  # lists never equal the values filters are made of
+                continue
+            self.posting_sets.setdefault((key, value), set()).add(index)
+
+    def matches(self, filter_set):
+        """Indexes, in insertion order, of the entries having all the values of filter_set."""
+        if not filter_set:
+            return range(len(self.entries))
+        try:
+            if any(value is None for value in filter_set.values()):
+                raise TypeError  # entries missing the variable match None too
+            postings = sorted(((self.postings.get((key, value), []), (key, value)) for key, value in filter_set.items()), key=lambda posting: len(posting[0]))
+        except TypeError:
+            return [index for index, entry in enumerate(self.entries) if all(entry.get(key) == value for key, value in filter_set.items())]
+        candidates = postings[0][0]
+        others = [self.posting_sets.get(pair, set()) for _, pair in postings[1:]]
+        return [index for index in candidates if all(index in other for other in others)]
+
+    def filter(self, filter_set=None, system_only=False):
+        """
+        Unique messages of the entries matching filter_set, in the order they were added.
+
+        :param filter_set: Dictionary of the variable values the entries must have, None for all entries
+        :param system_only: Keep only the system messages
+        """
+        seen = set()
+        out = []
+        for index in self.matches(filter_set):
+            for message_id in self.entry_messages[index]:
+                if message_id in seen:
+                    continue
+                message = self.messages[message_id]
+                if system_only and message.get('role') != 'system':
+                    continue
+                seen.add(message_id)
+                out.append(message)
+        return out
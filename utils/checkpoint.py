@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+def write_json(path, data):
+    """Write data as JSON through a temporary file, so a crash never leaves a truncated file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
+def title_file_name(title):
+    """File name of the data saved for a query title, whatever characters the title has."""
+    return f"{hashlib.blake2b(title.encode(), digest_size=8).hexdigest()}.json"
+
+class CheckpointStore:
+    """
+    Saves the processed results of each query title, so an interrupted run can be resumed without solving them again.
+
+    Checkpoints are kept in a folder per run fingerprint, computed from the inputs and query definitions, so a run
+    never resumes from the checkpoints of different inputs or queries.
+    """
+    def __init__(self, fingerprint, folder='data/checkpoints'):
+        self.folder = os.path.join(folder, fingerprint)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(*values):
+        """Fingerprint of the run definition, e.g. its inputs and queries."""
+        return hashlib.blake2b(json.dumps(values, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+
+    def _path(self, title):
+        return os.path.join(self.folder, title_file_name(title))
+
+    def save(self, title, processed):
+        """
+        Save the processed results of a title.
+
+        :param title: The query title
+        :param processed: Tuple of results, queries made, solved dependencies and chat history returned by process_prepared_queries
+        """
+        with self.lock:
+            write_json(self._path(title), {'title': title, 'processed': list(processed)})
+
+    def load(self, title):
+        """Return the processed results saved for a title, or None when it has no checkpoint."""
+        try:
+            with open(self._path(title), 'r', encoding='utf-8') as file:
+                checkpoint = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return tuple(checkpoint['processed']) if checkpoint.get('title') == title else None
+
+    def clear(self):
+        """Delete the checkpoints of the run, once its results are saved."""
+        with self.lock:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+class ResultStore:
+    """
+    Results of the prepared queries of the last run of each title, by fingerprint of the call they made.
+
+    The fingerprint covers the rendered query definition and the variable values it uses, so an incremental run reuses
+    the results of every prepared query whose definition, inputs and upstream results didn't change.
+    """
+    def __init__(self, folder='data/results'):
+        self.folder = folder
+
+    @staticmethod
+    def fingerprint(*values):
+        """Fingerprint of the call made by a prepared query."""
+        return hashlib.blake2b(json.dumps(values, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+    def load(self, title):
+        """Return the results saved for a title, by fingerprint."""
+        try:
+            with open(os.path.join(self.folder, title_file_name(title)), 'r', encoding='utf-8') as file:
+                saved = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        return saved['results'] if saved.get('title') == title else {}
+
+    def save(self, title, results):
+        """Replace the results saved for a title by those of the current run."""
+        write_json(os.path.join(self.folder, title_file_name(title)), {'title': title, 'results': results})
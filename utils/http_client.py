@@ -0,0 +1,74 @@
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from config import config
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class HttpClient:
+    """
+    Shared HTTP transport used by all search and AI backends.
+
+    Connections are pooled per host and kept alive between calls, every request gets a default timeout,
+    and 429/5xx responses or connection errors are retried with jittered exponential backoff.
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=20, max_retries=3, backoff_factor=1, backoff_max=60, timeout=60):
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.backoff_max = float(backoff_max)
+        self.timeout = float(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=int(pool_connections), pool_maxsize=int(pool_maxsize))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def backoff(self, attempt, response=None):
+        """Delay before the next attempt, honoring a Retry-After header when the server sends one."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass  # HTTP-date values fall back to the exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))  # full jitter
+
+    def request(self, method, url, rate_limiter=None, **kwargs):
+        """
+        Send a request through the pooled session.
+
+        :param method: HTTP method, e.g. 'GET' or 'POST'
+        :param url: The request URL
+        :param rate_limiter: RateLimiter of the provider, acquired before each retry and throttled on 429 responses (the caller acquires it for the first attempt)
+        :param kwargs: Any requests keyword argument (params, headers, json, timeout, ...)
+        :return: The last requests.Response received, which may still be an error status once retries are exhausted
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            if rate_limiter and attempt > 0:
+                rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                print(f"[HTTP] {method} {url} failed with {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    if rate_limiter and response.status_code != 429:
+                        rate_limiter.recover()
+                    return response
+                delay = self.backoff(attempt, response)
+                if rate_limiter and response.status_code == 429:
+                    rate_limiter.throttle(delay)  # slow down every caller of the provider, not just this one
+                print(f"[HTTP] {method} {url} returned status {response.status_code}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+
+    def get(self, url, rate_limiter=None, **kwargs):
+        return self.request('GET', url, rate_limiter, **kwargs)
+
+    def post(self, url, rate_limiter=None, **kwargs):
+        return self.request('POST', url, rate_limiter, **kwargs)
+
+http_client = HttpClient(**config['http'])
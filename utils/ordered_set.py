@@ -0,0 +1,106 @@
+import json
+
+class OrderedSet(list):
+    """
+    List of unique items in insertion order, grown incrementally as the results of a query come in.
+
+    A companion set makes membership checks and additions constant time, and the text forms used to render the list in
+    a query are memoized until the next addition, so large _set variables are only converted once.
+    """
+    def __init__(self, items=()):
+        super().__init__()
+        self.keys = set()
+        self.texts = {}  # list mode -> text of the items
+        self.update(items)
+
+    @staticmethod
+    def key(item):
+        """Set key of an item, unhashable items (e.g. dictionaries) being compared by their JSON form."""
+        try:
+            hash(item)
+            return item
+        except TypeError:
+            return json.dumps(item, sort_keys=True, default=str)
+
+    def add(self, item):
+        """Append item unless it is already in the set."""
+        key = self.key(item)
+        if key not in self.keys:
+            self.keys.add(key)
+            super().append(item)
+            self.texts.clear()
+
+    append = add
+
+    def update(self, items):
+        """Append the items not in the set yet, in their order."""
+        for item in items:
+            self.add(item)
+
+    extend = update
+
+    def __iadd__(self, items):
+        self.update(items)
+        return self
+
+    def insert(self, index, item):
+        """Insert item at index unless it is already in the set."""
+        key = self.key(item)
+        if key not in self.keys:
+            self.keys.add(key)
+            super().insert(index, item)
+            self.texts.clear()
+
+    def remove(self, item):
+        super().remove(item)
+        self.keys.discard(self.key(item))
+        self.texts.clear()
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.keys.discard(self.key(item))
+        self.texts.clear()
+        return item
+
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        for item in removed:
+            self.keys.discard(self.key(item))
+        self.texts.clear()
+
+    def __setitem__(self, index, value):
+        """Replace items, the new items already in the set elsewhere being dropped to keep them unique."""
+        items = list(self)
+        items[index] = value
+        self.clear()
+        self.update(items)
+
+    def clear(self):
+        super().clear()
+        self.keys.clear()
+        self.texts.clear()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.texts.clear()
+
+    def reverse(self):
+        super().reverse()
+        self.texts.clear()
+
+    def __imul__(self, count):
+        raise TypeError("OrderedSet items are unique, they can't be repeated")
+
+    def __reduce__(self):
+        # copy, deepcopy and pickle rebuild the set from its items, the keys and texts are derived from them
+        return (type(self), (list(self),))
+
+    def __contains__(self, item):
+        return self.key(item) in self.keys
+
+    def text(self, listMode, convert):
+        """Text of the items in listMode, computed by convert(items, listMode) on the first call after a change."""
+        if listMode not in self.texts:
+            self.texts[listMode] = convert(self, listMode)
+        return self.texts[listMode]
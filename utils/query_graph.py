@@ -0,0 +1,98 @@
+class QueryGraph:
+    """
+    Dependency DAG of the queries, each query waiting for the queries that provide the variables and titles it uses.
+
+    Nodes are the indexes of the queries. Variables provided by the inputs don't create edges, and a variable provided
+    by several queries makes its users wait for all of them.
+    """
+    def __init__(self, titles, dependencies, provided, input_variables):
+        """
+        :param titles: Title of each query
+        :param dependencies: Set of variables and titles each query depends on
+        :param provided: Set of variables and titles each query makes available once solved
+        :param input_variables: Variables provided by the inputs
+        """
+        self.titles = titles
+        self.dependencies = dependencies
+        self.input_variables = set(input_variables)
+        self.providers = {}  # variable -> indexes of the queries providing it
+        for index, variables in enumerate(provided):
+            for variable in variables:
+                self.providers.setdefault(variable, []).append(index)
+
+        self.parents = [set() for _ in titles]
+        self.children = [set() for _ in titles]
+        self.missing = [set() for _ in titles]  # variables no input or other query provides
+        for index, deps in enumerate(dependencies):
+            for dep in deps:
+                if dep in self.input_variables:
+                    continue
+                parents = [parent for parent in self.providers.get(dep, []) if parent != index]
+                if not parents:
+                    self.missing[index].add(dep)
+                for parent in parents:
+                    self.parents[index].add(parent)
+                    self.children[parent].add(index)
+        self.levels = None
+
+    def topological_order(self):
+        """
+        Sort the queries with Kahn's algorithm, level by level, so every query comes after the queries it depends on.
+
+        :return: List of query indexes, also grouped by level in self.levels
+        :raises ValueError: When queries depend on each other in a cycle or on variables nothing provides
+        """
+        indegree = [len(parents) for parents in self.parents]
+        level = [index for index in range(len(self.titles)) if not indegree[index] and not self.missing[index]]
+        self.levels = []
+        order = []
+        while level:
+            self.levels.append(level)
+            order.extend(level)
+            next_level = []
+            for index in level:
+                for child in self.children[index]:
+                    indegree[child] -= 1
+                    if not indegree[child] and not self.missing[child]:
+                        next_level.append(child)
+            level = sorted(next_level)
+
+        if len(order) < len(self.titles):
+            solved = set(order)
+            print("[Query Processor] Circular dependency detected for the following queries:")
+            for index in range(len(self.titles)):
+                if index not in solved:
+                    unsolved = self.missing[index] | {dep for dep in self.dependencies[index] if dep not in self.input_variables and set(self.providers.get(dep, [])) - solved - {index}}
+                    print(f" - Title: {self.titles[index]}, unsolved dependencies: {unsolved}")
+            raise ValueError("Circular dependency detected in queries")
+        return order
+
+    def describe(self):
+        """Return the titles each query waits for, by query title."""
+        return {self.titles[index]: sorted(self.titles[parent] for parent in parents) for index, parents in enumerate(self.parents)}
+
+    def critical_path(self, durations):
+        """
+        Find the chain of dependent queries with the longest total duration, which bounds the duration of the whole run.
+
+        :param durations: Duration in seconds of each processed query, by query index
+        :return: Tuple of the titles on the critical path and its total duration
+        """
+        finish = {}
+        previous = {}
+        for index in (index for level in self.levels or [] for index in level):
+            if index not in durations:
+                continue
+            parents = [parent for parent in self.parents[index] if parent in finish]
+            parent = max(parents, key=finish.get) if parents else None
+            previous[index] = parent
+            finish[index] = durations[index] + (finish[parent] if parent is not None else 0)
+        if not finish:
+            return [], 0
+        index = max(finish, key=finish.get)
+        total = finish[index]
+        path = []
+        while index is not None:
+            path.append(self.titles[index])
+            index = previous[index]
+        return path[::-1], total
@@ -1,19 +1,38 @@
 
 import json
-import re
+import heapq
 import itertools
 import math
+import time
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from ai_utils.ai_services import ai_query
 from search_utils.search_engine import perform_search
-from utils.utils import utils
+from utils.query_graph import QueryGraph
+from utils.checkpoint import CheckpointStore, ResultStore
+from utils.chat_history import ChatHistoryIndex, chat_messages
+from utils.template import Template
+from utils.ordered_set import OrderedSet
+from utils.tokens import count_message_tokens
+
+def hashable(value):
+    """Return value as a dictionary key, lists becoming tuples."""
+    return tuple(hashable(item) for item in value) if isinstance(value, list) else value
 
 class QueryProcessor:
-    def __init__(self, inputs, llm_queries, search_queries, config):
+    def __init__(self, inputs, llm_queries, search_queries, config, resume=False, incremental=False):
         self.inputs = inputs
         self.llm_queries = llm_queries
         self.search_queries = search_queries
         self.config = config
         
+        # Checkpoints of the solved titles, restored instead of solved again when resuming an interrupted run
+        self.resume = resume
+        self.checkpoints = CheckpointStore(CheckpointStore.fingerprint(inputs, llm_queries, search_queries, config['test_mode'], config['test']))
+        # Results of the prepared queries of the last run, reused for the unchanged ones in incremental runs
+        self.incremental = incremental
+        self.previous_results = ResultStore()
+        
         # Initialize AI service and model
         self.ai_service = self.config['default_ai_service']
         self.model = self.config['ai_services'][self.ai_service]['model']
@@ -22,6 +41,11 @@ class QueryProcessor:
         self.dateRestrict = self.config['default_search_period']
         self.disable_cache = self.config['default_disable_cache']
         self.batch_process = self.config['llm_batch_process']
+        self.search_max_workers = int(self.config.get('search_max_workers') or 1)
+        self.llm_realtime_max_workers = int(self.config.get('llm_realtime_max_workers') or 1)
+        self.max_parallel_queries = int(self.config.get('max_parallel_queries') or 1)
+        self.max_prompt_tokens = int(self.config.get('llm_max_prompt_tokens') or 0)
+        self.graph = None # dependency graph of the queries, built by analyze_dependencies
 
     @staticmethod
     def parse_dynamic_var(dynamic_var):
@@ -30,63 +54,98 @@ class QueryProcessor:
             return [var.strip() for var in dynamic_var.split(',') if var.strip()]
         return []
 
-    def analyze_dependencies(self):
-        """Analyze dependencies among queries and sort them."""
+    def provided_variables(self, query):
+        """Variables made available once a query is solved: its title, its dynamic variables and their _set and _group variants."""
+        dynamic_vars = self.parse_dynamic_var(query['dynamic_var'])
+        new_dynamic_vars = list(set(var if var.endswith('_set')  else f"{var}_set" for var in dynamic_vars)) + list(set(f"{var}_group" for var in dynamic_vars if not var.endswith('_set'))) + dynamic_vars
+        return set(new_dynamic_vars) | {query.get('title').strip()}
+
+    @staticmethod
+    def query_dependencies(query):
+        """Variables (placeholders) and titles (dependency column) a query depends on."""
+        dependencies = set(dep.strip() for dep in Template(query).variables)
+        if 'dependency' in query and query['dependency']:
+            for value in query['dependency'].split(','):
+                dependencies.add(value.strip())
+        return dependencies
+
+    def build_graph(self):
+        """Build the dependency graph of the llm and search queries."""
         all_queries = self.llm_queries + self.search_queries
-        
-        dependency_graph = {}
-        available_variables = set()
 
         # Add input-based variables
+        input_variables = set()
         for input_dict in self.inputs:
             for header in input_dict.keys():
-                available_variables.add(header.strip())
-                available_variables.add(f"{header.strip()}_set")
-
-        for i, query in enumerate(all_queries):
-            query_str = json.dumps(query)
-            dependencies = set(dep.strip() for dep in re.findall(r'\[\[(.*?)\]\]', query_str))
-            dependency_graph[i] = dependencies
-            if 'dependency' in query and query['dependency']:
-                for value in query['dependency'].split(','):
-                    dependencies.add(value.strip())
-
-        sorted_indices = []
-        remaining_indices = set(range(len(all_queries)))
-
-        while remaining_indices:
-            independent_indices = [
-                i for i in remaining_indices 
-                if not (dependency_graph[i] - available_variables)
-            ]
-            if not independent_indices:
-                print("[Query Processor] Circular dependency detected for the following queries:")
-                for i in remaining_indices:
-                    query = all_queries[i]
-                    print(f" - Title: {query.get('title')}, unsolved dependencies: {(dependency_graph[i] - available_variables)}")
-                raise ValueError("Circular dependency detected in queries")
-            sorted_indices.extend(independent_indices)
-            remaining_indices -= set(independent_indices)
-
-            # Update available variables
-            for i in independent_indices:
-                query = all_queries[i]
-                dynamic_vars = self.parse_dynamic_var(query['dynamic_var'])
-                new_dynamic_vars = list(set(var if var.endswith('_set')  else f"{var}_set" for var in dynamic_vars)) + list(set(f"{var}_group" for var in dynamic_vars if not var.endswith('_set'))) + dynamic_vars
-                available_variables.update(new_dynamic_vars)
-                available_variables.add(query.get('title').strip())
-
-        # Create a mapping from original index to sorted index
-        index_mapping = {original: sorted for sorted, original in enumerate(sorted_indices)}
-
-        # Update dependency_graph keys to reflect new order
-        updated_dependency_graph = {index_mapping[i]: deps for i, deps in dependency_graph.items()}
-
-        return [all_queries[i] for i in sorted_indices], updated_dependency_graph
+                input_variables.add(header.strip())
+                input_variables.add(f"{header.strip()}_set")
+
+        return QueryGraph([query.get('title') for query in all_queries], [self.query_dependencies(query) for query in all_queries], [self.provided_variables(query) for query in all_queries], input_variables)
+
+    def analyze_dependencies(self):
+        """Analyze dependencies among queries and sort them."""
+        all_queries = self.llm_queries + self.search_queries
+        self.graph = self.build_graph()
+        sorted_indices = self.graph.topological_order()
+
+        # Dependencies of each query, by its position in the sorted queries
+        dependency_graph = {position: self.graph.dependencies[index] for position, index in enumerate(sorted_indices)}
+
+        return [all_queries[i] for i in sorted_indices], dependency_graph
+
+    def expected_fan_out(self, dependencies):
+        """
+        Count the prepared queries a query expands to, from the inputs alone so before any call is made.
+
+        Args:
+            dependencies (set): Variables and titles the query depends on.
+
+        Returns:
+            tuple: The number of input combinations, and the dynamic variables each combination is further expanded over once their values are known.
+        """
+        input_sets = {k: v for item in self.inputs for k, v in item.items()}
+        combinations = math.prod(len(input_sets[dep]) for dep in dependencies if dep in input_sets) # one prepared query per combination of loop inputs
+        titles = set(self.graph.titles) if self.graph else set()
+        dynamic_vars = sorted(dep for dep in dependencies if dep not in input_sets and dep not in titles and not dep.endswith(('_set', '_group')))
+        return combinations, dynamic_vars
+
+    def estimate_search_calls(self):
+        """
+        Estimate the search engine calls needed by the queries, before running them.
+
+        The estimate is an upper bound: cached searches aren't sent and Google stops fetching pages after the last result.
+
+        Returns:
+            tuple: A tuple containing:
+            - calls (dict): Number of calls per search engine of the search queries depending only on inputs
+            - unknown (list): Titles of the search queries whose number of calls depends on llm results
+        """
+        sorted_queries, dependency_graph = self.analyze_dependencies()
+        queries_to_process = sorted_queries[:self.config['test']['queries_limit']] if self.config['test_mode'] else sorted_queries
+        input_sets = {k: v for item in self.inputs for k, v in item.items()}
+        input_variables = set(input_sets) | {f"{k}_set" for k in input_sets}
+        titles = {query.get('title').strip() for query in self.llm_queries + self.search_queries}
+
+        calls = {}
+        unknown = []
+        for query_index, query in enumerate(queries_to_process):
+            if query not in self.search_queries:
+                continue
+            dependencies = dependency_graph.get(query_index, set()) - titles
+            if not dependencies <= input_variables:
+                unknown.append(query['title'])
+                continue
+            searches, _ = self.expected_fan_out(dependencies)
+            search_engine = query.get('search_engine') or self.search_engine
+            number_of_results = self.config['test']['search_results'] if self.config['test_mode'] else int(query.get('num_results') or self.num_results)
+            pages = math.ceil(min(max(number_of_results, 10), 100) / 10) if search_engine == 'google' else 1
+            calls[search_engine] = calls.get(search_engine, 0) + searches * pages
+        return calls, unknown
 
     def process_prepared_queries(self, prepared_queries, batch_process=False):
         """
-        Process queries, optionally in a batch if batch_process is set to True.
+        Process queries, optionally in a batch if batch_process is set to True, otherwise as concurrent realtime calls
+        when llm_realtime_max_workers allows more than one request in flight.
         
         Args:
             prepared_queries (list): List of queries to be processed.
@@ -103,67 +162,130 @@ class QueryProcessor:
         queries_made = []
         chat_history = []
         query_solved_dependencies = {}
+        searches = []
+        title = prepared_queries[0]['raw_query']['title']
+        previous_results = self.previous_results.load(title) if self.incremental else {}
+        fingerprints = [None] * len(prepared_queries)
+        sent_llm_requests = {} # responses of the individual llm calls, so identical requests of other combinations aren't sent again
+        # every prepared query renders the same raw query, compiled once with its list conversions shared
+        raw_query = prepared_queries[0]['raw_query']
+        template = Template(raw_query)
+        conversions = {}
+        is_search_query = raw_query in self.search_queries
+        is_llm_query = not is_search_query and raw_query in self.llm_queries
 
         if isinstance(batch_process, str):
             batch_process = batch_process.lower() == 'true'
+        # llm queries are sent in a single call, either as a batch job or as concurrent realtime requests
+        grouped_llm_call = (batch_process or self.llm_realtime_max_workers > 1) and len(prepared_queries) > 1
 
         # replace placeholders in queries
         for query_index, query in enumerate(prepared_queries):
-            # solving search queries sequentially
-            if query['raw_query'] in self.search_queries:
+            # preparing search queries, which are dispatched concurrently once all of them are rendered
+            if is_search_query:
                 print(f"[Query Processor] {query['message']}")
                 batch_process = False
-                upd_query, replaced_items = utils.replace_placeholders(query["raw_query"], variables=query["replace_vars"], listMode='list_str') # replacing variable placeholders
+                grouped_llm_call = False
+                upd_query, replaced_items = template.render(query["replace_vars"], listMode='list_str', conversions=conversions) # replacing variable placeholders
                 prepared_queries[query_index]['replaced_items'] = {**replaced_items}
                 prepared_queries[query_index]['query'] = {**upd_query}
                 queries_made.append({**replaced_items, **upd_query})
                 number_of_results = self.config['test']['search_results'] if self.config['test_mode'] else int(query['query'].get('num_results') or self.num_results)
                 number_of_results = min(max(math.ceil(number_of_results / 10) * 10, 10), 100) # multiples of 10, in between 10 and 100
-                res = perform_search(upd_query.get('search_query') or '', upd_query.get('exactTerms') or '', upd_query.get('orTerms') or '', number_of_results, query['query'].get('dateRestrict') or self.dateRestrict, query['query'].get('search_engine') or self.search_engine, disable_cache=query['query'].get('disable_cache') or self.disable_cache)
-                prepared_queries[query_index]['result'] = [{ **replaced_items, **e } for e in res]
-                results.extend(prepared_queries[query_index]['result'])
+                search_args = (upd_query.get('search_query') or '', upd_query.get('exactTerms') or '', upd_query.get('orTerms') or '', number_of_results, query['query'].get('dateRestrict') or self.dateRestrict, query['query'].get('search_engine') or self.search_engine)
+                fingerprints[query_index] = self.previous_results.fingerprint(upd_query, replaced_items, search_args)
+                if self.reuse_previous_result(prepared_queries[query_index], previous_results.get(fingerprints[query_index])):
+                    continue
+                searches.append((query_index, search_args, {'disable_cache': query['query'].get('disable_cache') or self.disable_cache}))
             # solving llm queries either in batch mode or in sequential mode
-            elif query['raw_query'] in self.llm_queries:
-                upd_query, replaced_items = utils.replace_placeholders(query["raw_query"], variables=query["replace_vars"], listMode='array_str') # replacing variable placeholders
+            elif is_llm_query:
+                upd_query, replaced_items = template.render(query["replace_vars"], listMode='array_str', conversions=conversions) # replacing variable placeholders
                 prepared_queries[query_index]['replaced_items'] = {**replaced_items}
                 prepared_queries[query_index]['query'] = {**upd_query}
                 queries_made.append({**replaced_items, **upd_query})
-                if not batch_process or len(prepared_queries)==1:
+                fingerprints[query_index] = self.previous_results.fingerprint(upd_query, replaced_items, query.get('chat'), self.ai_service, self.model)
+                if self.reuse_previous_result(prepared_queries[query_index], previous_results.get(fingerprints[query_index])):
+                    continue
+                # prompts over the token budget are sent as one call per chunk of their largest list variable
+                query['calls'] = self.split_prompt(template, query, conversions)
+                if not grouped_llm_call:
                     # Process queries individually
                     print(f"[Query Processor] {query['message']}")
-                    responses, current_chat_instance, full_history = ai_query(queries=upd_query.get('query'), role=upd_query.get('role') or None, format=upd_query.get('format') or None, chat_history=query.get('chat') or None, ai_service=query['query'].get('model') or self.ai_service, model=query['query'].get('model') or self.model, disable_cache=query['query'].get('disable_cache') or self.disable_cache)
-                    error_messages = [d['error'] for d in responses if isinstance(d, dict) and 'error' in d] if isinstance(responses, list) else []
-                    if error_messages:
-                        print(error_messages)
-                    try:
-                        res = json.loads(responses[0] if isinstance(responses, list) else responses)
-                    except json.JSONDecodeError:  # Added exception handling
-                        pass  # Do nothing if an error occurs 
-                    if 'result' in res: #results are included in a result dicitionary due to the json schema I use
-                        prepared_queries[query_index]['result'] = res['result']
-                    else:
-                        prepared_queries[query_index]['result'] = res
-                    results.extend(prepared_queries[query_index]['result'])
-                    chat_history.append({ **prepared_queries[query_index]['replaced_items'], 'chat_history': current_chat_instance[0] })
+                    call_responses = []
+                    call_chat_instances = []
+                    for call in query['calls']:
+                        request = json.dumps((call.get('query'), call.get('role'), call.get('format'), query.get('chat'), query['query'].get('model'), query['query'].get('disable_cache')), sort_keys=True, default=str)
+                        if request in sent_llm_requests:
+                            call_responses.append(sent_llm_requests[request][0])
+                            call_chat_instances.append(sent_llm_requests[request][1])
+                            continue
+                        responses, current_chat_instance, full_history = ai_query(queries=call.get('query'), role=call.get('role') or None, format=call.get('format') or None, chat_history=query.get('chat') or None, ai_service=query['query'].get('model') or self.ai_service, model=query['query'].get('model') or self.model, disable_cache=query['query'].get('disable_cache') or self.disable_cache, batch_process=False)
+                        error_messages = [d['error'] for d in responses if isinstance(d, dict) and 'error' in d] if isinstance(responses, list) else []
+                        if error_messages:
+                            print(error_messages)
+                        sent_llm_requests[request] = (responses[0] if isinstance(responses, list) else responses, current_chat_instance[0] if current_chat_instance else None)
+                        call_responses.append(sent_llm_requests[request][0])
+                        call_chat_instances.append(sent_llm_requests[request][1])
+                    self.set_llm_result(prepared_queries[query_index], call_responses, call_chat_instances)
+
+        # solving search queries concurrently, results are kept in the original combination order
+        if searches:
+            # combinations rendering identical searches share a single call, its results tagged with the replaced items of each
+            unique_searches = {}
+            for query_index, args, kwargs in searches:
+                unique_searches.setdefault((args, tuple(sorted(kwargs.items()))), (args, kwargs, []))[2].append(query_index)
+            if len(unique_searches) < len(searches):
+                print(f"[Query Processor] {len(searches)} searches of {title} render to {len(unique_searches)} distinct requests")
+            search_responses = self.run_searches([(args, kwargs) for args, kwargs, _ in unique_searches.values()])
+            for (_, _, query_indexes), res in zip(unique_searches.values(), search_responses):
+                for query_index in query_indexes:
+                    if not isinstance(res, list):
+                        print(f"[Query Processor] Search failed for {prepared_queries[query_index]['message']}: {res.get('error') if isinstance(res, dict) else res}")
+                        prepared_queries[query_index]['failed'] = True
+                    prepared_queries[query_index]['result'] = [{ **prepared_queries[query_index]['replaced_items'], **e } for e in (res if isinstance(res, list) else [])]
         
-        if batch_process and len(prepared_queries)>1: 
-            print("[Query Processor] Starting batch call to llm")
-            queries = [d["query"].get("query", []) for d in prepared_queries]
-            roles = [d["query"].get("role", []) for d in prepared_queries]
-            formats = [d["query"].get("format", []) for d in prepared_queries] 
-            chart_histories = [d["query"].get("chart_history", []) for d in prepared_queries]
-            responses, current_chat_instance, full_history = ai_query(queries=queries, role=roles, format=formats, chat_history=chart_histories, ai_service=prepared_queries[0]['query'].get('ai_service') or self.ai_service, model=prepared_queries[0]['query'].get('model') or self.model, disable_cache=prepared_queries[0]['query'].get('disable_cache') or self.disable_cache)
-            for query_index, query in enumerate(prepared_queries):
-                try:
-                    res = json.loads(responses[query_index])
-                except json.JSONDecodeError:  # Added exception handling
-                    pass  # Do nothing if an error occurs 
-                if 'result' in res: #results are included in a result dicitionary due to the json schema I use
-                    prepared_queries[query_index]['result'] = res['result']
-                else:
-                    prepared_queries[query_index]['result'] = res
-                results.extend(prepared_queries[query_index]['result'])
-                chat_history.append({ **prepared_queries[query_index]['replaced_items'], 'chat_history': current_chat_instance[query_index] })
+        # llm queries not reused from the previous run
+        llm_calls = [query for query in prepared_queries if 'result' not in query] if grouped_llm_call else []
+        if llm_calls:
+            print(f"[Query Processor] Starting {'batch' if batch_process else 'concurrent realtime'} call to llm")
+            calls = [(query, call) for query in llm_calls for call in query['calls']]
+            # identical requests of different combinations are sent once, also within a batch job, and their response shared
+            requests = []
+            request_indexes = {}
+            call_requests = []
+            for query, call in calls:
+                if batch_process:
+                    chart_history = call.get("chart_history", [])
+                else: # same chat history as individual calls, so their cached results are reused
+                    chart_history = query.get('chat') or None
+                request = (call.get("query", []), call.get("role", []), call.get("format", []), chart_history)
+                key = json.dumps(request, sort_keys=True, default=str)
+                if key not in request_indexes:
+                    request_indexes[key] = len(requests)
+                    requests.append(request)
+                call_requests.append(request_indexes[key])
+            if len(requests) < len(calls):
+                print(f"[Query Processor] {len(calls)} llm calls of {title} render to {len(requests)} distinct requests")
+            queries, roles, formats, chart_histories = (list(column) for column in zip(*requests))
+            responses, current_chat_instance, full_history = ai_query(queries=queries, role=roles, format=formats, chat_history=chart_histories, ai_service=llm_calls[0]['query'].get('ai_service') or self.ai_service, model=llm_calls[0]['query'].get('model') or self.model, disable_cache=llm_calls[0]['query'].get('disable_cache') or self.disable_cache, batch_process=batch_process)
+            call_index = 0
+            for query in llm_calls:
+                count = len(query['calls'])
+                indexes = call_requests[call_index:call_index + count]
+                self.set_llm_result(query, [responses[index] for index in indexes], [current_chat_instance[index] for index in indexes])
+                call_index += count
+
+        # results and chat history in the order of the prepared queries
+        for query in prepared_queries:
+            results.extend(query['result'])
+            if query.get('chat_instance'): # failed requests have no chat instance
+                chat_history.append({ **query['replaced_items'], 'chat_history': query['chat_instance'] })
+
+        # results of this run, reused by the next incremental run unless they failed
+        reused = sum(1 for query in prepared_queries if query.get('reused'))
+        if reused:
+            print(f"[Query Processor] Reused the results of {reused} of {len(prepared_queries)} prepared queries of {title} from the previous run")
+        self.previous_results.save(title, {fingerprint: {'result': query['result'], 'chat_instance': query.get('chat_instance')} for fingerprint, query in zip(fingerprints, prepared_queries) if fingerprint and not query.get('failed')})
         
         # Create new sets information from query results based on dynamic_vars
         query_solved_dependencies = {}
@@ -179,120 +301,305 @@ class QueryProcessor:
                     if f"{var}_group" not in query_solved_dependencies:
                         query_solved_dependencies[f"{var}_group"] = []
                     if f"{var}_set" not in query_solved_dependencies:
-                        query_solved_dependencies[f"{var}_set"] = []
+                        query_solved_dependencies[f"{var}_set"] = OrderedSet()
                     if items:
-                        query_solved_dependencies[f"{var}_set"] = list(set(query_solved_dependencies[f"{var}_set"]).union(items))
+                        query_solved_dependencies[f"{var}_set"].update(items)
                         query_solved_dependencies[f"{var}_group"].append({**query['replaced_items'], **{f"{var}_set":items}}) 
         
         return results, queries_made, query_solved_dependencies, chat_history
         
+    def run_searches(self, searches):
+        """
+        Run search calls with at most search_max_workers requests in flight.
+
+        Args:
+            searches (list): List of (args, kwargs) tuples to be passed to perform_search.
+
+        Returns:
+            list: Search results in the same order as searches.
+        """
+        if self.search_max_workers <= 1 or len(searches) <= 1:
+            return [perform_search(*args, **kwargs) for args, kwargs in searches]
+        print(f"[Query Processor] Running {len(searches)} searches with up to {self.search_max_workers} in flight")
+        with ThreadPoolExecutor(max_workers=min(self.search_max_workers, len(searches))) as executor:
+            return list(executor.map(lambda search: perform_search(*search[0], **search[1]), searches))
+
+    @staticmethod
+    def parse_llm_response(response):
+        """
+        Parse an LLM response into its list of results.
+
+        Args:
+            response (str or dict): JSON response of the LLM, or an error dictionary for a failed request.
+
+        Returns:
+            list: The results of the response, None for failed requests and invalid JSON.
+        """
+        if isinstance(response, dict) and 'error' in response:
+            print(f"[Query Processor] LLM request failed: {response['error']}")
+            return None
+        try:
+            res = json.loads(response)
+        except (json.JSONDecodeError, TypeError):
+            print(f"[Query Processor] Invalid JSON in LLM response: {str(response)[:200]}")
+            return None
+        if isinstance(res, dict) and 'result' in res: #results are included in a result dicitionary due to the json schema I use
+            return res['result']
+        return res
+
+    def set_llm_result(self, prepared_query, responses, chat_instances):
+        """
+        Set the parsed result and chat instance of a prepared llm query, marking the failed requests and the responses that
+        aren't valid JSON so their empty result isn't reused by incremental runs.
+
+        A prompt split into chunks has one response per chunk, their results are merged into a single list.
+        """
+        parsed_responses = [self.parse_llm_response(response) for response in responses]
+        if any(parsed is None for parsed in parsed_responses):
+            prepared_query['failed'] = True
+        if len(responses) == 1:
+            prepared_query['result'] = parsed_responses[0] if parsed_responses[0] is not None else []
+            prepared_query['chat_instance'] = chat_instances[0]
+            return
+        result = []
+        for parsed in parsed_responses:
+            if parsed is not None:
+                result.extend(parsed if isinstance(parsed, list) else [parsed])
+        prepared_query['result'] = result
+        prepared_query['chat_instance'] = [message for chat in chat_instances for message in chat_messages(chat)] if all(chat_instances) else None
+
+    def prompt_tokens(self, query, chat=None):
+        """Tokens of the prompt of a rendered llm query: its chat history, role, query and response format."""
+        response_format = query.get('format')
+        if response_format is not None and not isinstance(response_format, str):
+            response_format = json.dumps(response_format, default=str)  # the format schema is sent as JSON
+        messages = (chat or []) + [{'content': query.get('role')}, {'content': query.get('query')}]
+        if response_format:
+            messages.append({'content': response_format})
+        return count_message_tokens(messages, query.get('model') or self.model)
+
+    def split_prompt(self, template, prepared_query, conversions):
+        """
+        Rendered queries to send for a prepared llm query: the query itself when its prompt fits in llm_max_prompt_tokens,
+        otherwise one query per chunk of its largest list variable, their results being merged by set_llm_result.
+
+        Args:
+            template (Template): The compiled raw query of the prepared query.
+            prepared_query (dict): The prepared query, already rendered.
+            conversions (dict): Text of the lists already converted, see Template.format_value.
+
+        Returns:
+            list: The rendered queries to send.
+        """
+        upd_query = prepared_query['query']
+        tokens = self.prompt_tokens(upd_query, prepared_query.get('chat'))
+        if not self.max_prompt_tokens or tokens <= self.max_prompt_tokens:
+            return [upd_query]
+        lists = {key: value for key, value in prepared_query['replaced_items'].items() if isinstance(value, list) and len(value) > 1}
+        if not lists:
+            print(f"[Query Processor] Prompt of {prepared_query['message']} has {tokens} tokens, over llm_max_prompt_tokens ({self.max_prompt_tokens}), with no list variable to split")
+            return [upd_query]
+
+        key = max(lists, key=lambda k: len(Template.format_value(lists[k], 'array_str', conversions)))
+        items = lists[key]
+        count = 2
+        while True:
+            size = math.ceil(len(items) / count)
+            calls = [template.render(ChainMap({key: items[start:start + size]}, prepared_query['replace_vars']), listMode='array_str')[0] for start in range(0, len(items), size)]
+            largest = max(self.prompt_tokens(call, prepared_query.get('chat')) for call in calls)
+            if largest <= self.max_prompt_tokens or size == 1:
+                break
+            count = max(count + 1, math.ceil(count * largest / self.max_prompt_tokens))
+        print(f"[Query Processor] Prompt of {prepared_query['message']} has {tokens} tokens, over llm_max_prompt_tokens ({self.max_prompt_tokens}), split {key} into {len(calls)} chunks" + (f", the largest still has {largest} tokens" if largest > self.max_prompt_tokens else ""))
+        return calls
+
+    @staticmethod
+    def reuse_previous_result(prepared_query, previous):
+        """Set the result of the previous run on a prepared query, returns whether there was one to reuse."""
+        if previous is None:
+            return False
+        prepared_query['result'] = previous['result']
+        prepared_query['chat_instance'] = previous.get('chat_instance')
+        prepared_query['reused'] = True
+        return True
+
     def process_queries(self):
         """
-        Analyze dependencies, determine which queries to process, and execute them.
+        Build the dependency graph of the queries and execute them, each query starting as soon as the queries it
+        depends on are solved, with up to max_parallel_queries queries processed at once.
 
         :param config: Configuration dictionary.
         :return: Processed queries and query results.
         """
         # Analyze dependencies and sort queries
         sorted_queries, dependency_graph = self.analyze_dependencies()
+        sorted_indices = [index for level in self.graph.levels for index in level]
 
         # Determine which queries to process based on test_mode
         queries_to_process = sorted_queries[:self.config['test']['queries_limit']] if self.config['test_mode'] else sorted_queries
+        print(f"[Query Processor] Dependency graph of {len(sorted_queries)} queries in {len(self.graph.levels)} levels: {self.graph.describe()}")
         
         # Initialize values directly obtained from inputs data
         input_dict = {f"{k}_set": v for item in self.inputs for k, v in item.items()} 
-        input_dependencies = list(input_dict.keys()) 
-        input_loop_dependencies = [item[:-4] for item in input_dependencies]
 
         # start solving dependencies and running the queries
         query_results = {}
         query_results['queries'] = []
         chat_history = {}
+        queries_made = {} # title -> queries made, added to query_results['queries'] in the sorted order at the end
         solved_queries = set()
         available_dependencies_set = input_dict
-        
-        for query_index, query in enumerate(queries_to_process):
-            current_query = query['title']
-            print(f"[Query Processor] Solving Query number: {query_index+1} of {len(queries_to_process)}, named: {current_query}")
-            # intiliaze query dependable variables 
+        for query in queries_to_process:
+            query_results[query['title']] = []
+            chat_history[query['title']] = []
+
+        # Preflight of the prepared queries each query expands to
+        fan_out = [self.expected_fan_out(dependency_graph.get(position, set())) for position in range(len(queries_to_process))]
+        print(f"[Query Processor] Expected fan-out: {sum(count for count, _ in fan_out)} prepared queries from the inputs")
+        for query, (count, dynamic_vars) in zip(queries_to_process, fan_out):
+            print(f"  - {query['title']}: {count} prepared queries" + (f", each one expanded over the values of {dynamic_vars}" if dynamic_vars else ""))
+
+        def combinations(dependencies):
+            """
+            Lazily expand the combinations of input and group values a query is prepared for.
+
+            Yields the values of each combination (None when the query isn't expanded), the values used to filter the
+            chat history and the variables to replace, nothing when the dependencies can't be solved.
+            """
+            solved_dependencies = set(available_dependencies_set) | solved_queries
+            if all(dep in solved_dependencies for dep in dependencies): # check if we can solve the query with the available dependencies
+                yield None, None, {**available_dependencies_set}
+                return
+            # input dependencies
+            input_sets = {k[:-4]: v for k, v in input_dict.items() if k[:-4] in dependencies}
+            input_keys = tuple(input_sets)
+            # _group results indexed by their values of the input dependencies, so each combination looks its groups up instead of filtering them
+            group_indexes = {}
+            for key, entries in available_dependencies_set.items():
+                if key.endswith('_group'):
+                    group_index = {}
+                    for item in entries:
+                        group_index.setdefault(tuple(hashable(item.get(k)) for k in input_keys), []).extend(item[f"{key[:-6]}_set"])
+                    group_indexes[key] = group_index
+            solved_dependencies |= set(input_keys) | set(group_indexes)
+            if all(dep in solved_dependencies for dep in dependencies):
+                active_groups = None
+            else:
+                # loop over dynamic variable dependencies (_group elements)
+                active_groups = sorted({f"{dep}_group" for dep in dependencies if dep not in solved_dependencies and f"{dep}_group" in group_indexes})
+                if not active_groups or not all(dep in solved_dependencies or f"{dep}_group" in active_groups for dep in dependencies):
+                    return
+            for input_combination in itertools.product(*input_sets.values()):
+                tmp_input_set = dict(zip(input_keys, input_combination)) # loop dependable input dependencies
+                group_sets = {key: group_index.get(input_combination, []) for key, group_index in group_indexes.items()}
+                if active_groups is None:
+                    yield input_combination, tmp_input_set, ChainMap(group_sets, tmp_input_set, available_dependencies_set)
+                    continue
+                for group_combination in itertools.product(*(group_sets[key] for key in active_groups)):
+                    tmp_group_set = {key[:-6]: value for key, value in zip(active_groups, group_combination)}
+                    yield group_combination, {**tmp_input_set, **tmp_group_set}, ChainMap(tmp_group_set, group_sets, tmp_input_set, available_dependencies_set)
+
+        def prepare(current_query, query, dependencies):
+            """Prepare the query for every combination of the solved dependencies, returns the prepared queries and the dependencies available."""
             prepared_queries = []  
-            query_results[current_query] = []
-            chat_history[current_query] = []
-            curr_chat_history = []
-            dependencies = list(dependency_graph.get(query_index, set())) # current dependencies
+            curr_chat_history = ChatHistoryIndex()
             # load full history
             for dep in dependencies:
                 if isinstance(dep, str) and ',' in dep:  
                     dep_titles = [title.strip() for title in dep.split(',')]
                     for title in dep_titles:
                         if title in chat_history:
-                            curr_chat_history.extend(chat_history[title])  
+                            for entry in chat_history[title]:
+                                curr_chat_history.add(entry)
                 elif dep in query_results:
-                    curr_chat_history.extend(chat_history[dep]) 
-            # solved dependencies list and groups
-            solved_dependencies_set = {**available_dependencies_set}
-            solved_dependencies = list(solved_dependencies_set.keys()) + list(solved_queries)
-            if all(dep in solved_dependencies for dep in dependencies): # check if we can solve the query with the available dependencies
-                prepared_queries.append({"message": f"Solving query: {current_query}", 
+                    for entry in chat_history[dep]:
+                        curr_chat_history.add(entry)
+            for combination, filter_set, solved_dependencies_set in combinations(dependencies):
+                prepared_queries.append({"message": f"Solving query: {current_query}" + (f" with {combination}" if combination is not None else ""), 
                                          "raw_query":query, 
                                          "replace_vars":solved_dependencies_set, 
-                                         "chat": self.filter_chat_history(curr_chat_history, histType = query.get('histType'))})
+                                         "chat": self.filter_chat_history(curr_chat_history, filter_set=filter_set, histType = query.get('histType'))})
+            if prepared_queries:
                 solved_queries.add(current_query)
-            else:
-                # input dependencies
-                input_dependencies = [item for item in input_loop_dependencies if item in dependencies]
-                input_sets = {k[:-4]: v for k, v in input_dict.items() if k[:-4] in input_dependencies}
-                # initialize input variable dependencies 
-                tmp_input_set = {}
-                for input_combination in itertools.product(*list(input_sets.values())):
-                    tmp_input_set = {k: v for k, v in zip(list(input_sets.keys()), input_combination)} # loop dependable input dependencies 
-                    group_dependencies = [ dep.replace("_group", "") for dep in list(available_dependencies_set.keys()) if dep.endswith('_group') ]
-                    group_sets = {}
-                    if group_dependencies: # add _group dependency
-                        for group in group_dependencies:
-                            #filter_group = [item[f"{group}_set"] for item in available_dependencies_set if item.get(f"{group}_group") == f"{group}_group" and all(item.get(key) == value for key, value in tmp_input_set.items())]
-                            current_group_sets = {k:v for k,v in available_dependencies_set.items() if k == f"{group}_group"}[f"{group}_group"]
-                            filter_group_sets = [ item for item in current_group_sets if all(item.get(key) == value for key, value in tmp_input_set.items()) ]
-                            filter_group = [item[f"{group}_set"] for item in filter_group_sets]
-                            flattened_group = [item for sublist in filter_group for item in sublist]
-                            group_sets.update({f"{group}_group": flattened_group})
-                    solved_dependencies_set = {**available_dependencies_set, **tmp_input_set, **group_sets}
-                    solved_dependencies = list(solved_dependencies_set.keys()) + list(solved_queries)
-                    if all(dep in solved_dependencies for dep in dependencies): # check if we can solve the query with the available dependencies
-                        prepared_queries.append({"message": f"Solving query: {current_query} with {input_combination}", 
-                                                 "raw_query":query, 
-                                                 "replace_vars":solved_dependencies_set, 
-                                                 "chat": self.filter_chat_history(curr_chat_history, filter_set={**tmp_input_set}, histType = query.get('histType'))})
+            solved_dependencies = list(available_dependencies_set.keys()) + [k[:-4] for k in input_dict] + list(solved_queries)
+            return prepared_queries, solved_dependencies
+
+        def merge_results(title, processed):
+            nonlocal available_dependencies_set
+            results, title_queries_made, query_solved_dependencies, query_chat_history = processed
+            queries_made[title] = title_queries_made
+            query_results[title].extend(results)
+            chat_history[title].extend(query_chat_history)
+            available_dependencies_set = {**available_dependencies_set, **query_solved_dependencies}
+
+        def run(prepared_queries, batch_process):
+            start = time.monotonic()
+            processed = self.process_prepared_queries(prepared_queries, batch_process=batch_process)
+            return processed, time.monotonic() - start
+
+        # queries are started in the sorted order once all the queries they depend on are done
+        positions = {index: position for position, index in enumerate(sorted_indices[:len(queries_to_process)])}
+        indegree = {index: len(self.graph.parents[index]) for index in positions}
+        ready = [position for index, position in positions.items() if not indegree[index]]
+        heapq.heapify(ready)
+        running = {} # future -> position of the query
+        durations = {} # query index -> seconds
+        started = time.monotonic()
+
+        def release(position):
+            for child in self.graph.children[sorted_indices[position]]:
+                if child in positions:
+                    indegree[child] -= 1
+                    if not indegree[child]:
+                        heapq.heappush(ready, positions[child])
+
+        executor = ThreadPoolExecutor(max_workers=max(1, self.max_parallel_queries))
+        try:
+            while ready or running:
+                while ready and len(running) < max(1, self.max_parallel_queries):
+                    query_index = heapq.heappop(ready)
+                    query = queries_to_process[query_index]
+                    current_query = query['title']
+                    print(f"[Query Processor] Solving Query number: {query_index+1} of {len(queries_to_process)}, named: {current_query}")
+                    checkpoint = self.checkpoints.load(current_query) if self.resume else None
+                    if checkpoint is not None:
+                        print(f"[Query Processor] Query {current_query} restored from the checkpoint of the previous run")
                         solved_queries.add(current_query)
+                        merge_results(current_query, checkpoint)
+                        release(query_index)
+                        continue
+                    dependencies = list(dependency_graph.get(query_index, set())) # current dependencies
+                    prepared_queries, solved_dependencies = prepare(current_query, query, dependencies)
+                    if current_query in solved_queries:
+                        batch_process = query.get('batch_process') or self.batch_process
+                        if isinstance(batch_process, str):
+                            batch_process = batch_process.lower() == 'true'
+                        running[executor.submit(run, prepared_queries, batch_process)] = query_index
                     else:
-                        # loop over dynamic variable dependencies (_group elements)
-                        if group_dependencies:
-                            remaining_dependencies = [dep for dep in dependencies if not dep in solved_dependencies]
-                            active_groups = list(set([f"{g}_group" for g in remaining_dependencies if f"{g}_group" in list(available_dependencies_set.keys())] + [g for g in remaining_dependencies if g.endswith('_group')]))
-                            group_set = {k: v for k, v in group_sets.items() if k in active_groups}
-                            tmp_group_set = {}
-                            for group_combination in itertools.product(*list(group_set.values())):
-                                tmp_group_set = {k: v for k, v in zip([key.replace("_group", "") for key in group_set.keys()], group_combination)}
-                                solved_dependencies_set = {**available_dependencies_set, **tmp_input_set, **group_sets, **tmp_group_set}
-                                solved_dependencies = list(solved_dependencies_set.keys()) + list(solved_queries)
-                                if all(dep in solved_dependencies for dep in dependencies):
-                                    prepared_queries.append({"message": f"Solving query: {current_query} with {group_combination}", 
-                                                             "raw_query":query, 
-                                                             "replace_vars":solved_dependencies_set, 
-                                                             "chat": self.filter_chat_history(curr_chat_history, {**tmp_input_set, **tmp_group_set}, histType = query.get('histType'))})
-                                    solved_queries.add(current_query)
-            if current_query in solved_queries:
-                results, queries_made, query_solved_dependencies, query_chat_history = self.process_prepared_queries(prepared_queries, batch_process=query.get('batch_process') or self.batch_process)
-                query_results['queries'].extend(queries_made)
-                query_results[current_query].extend(results)
-                chat_history[current_query].extend(query_chat_history)
-                available_dependencies_set = {**available_dependencies_set, **query_solved_dependencies}
-            else:
-                print(f"[Query Processor] Warning: Not capable of solving dependency for query {current_query}")
-                missing = [dep for dep in dependencies if dep not in solved_dependencies]
-                print(f"  - missing dependencies:   {missing}")
-                print(f"  - required dependencies:  {dependencies}")
-                print(f"  - available dependencies: {solved_dependencies}")
+                        print(f"[Query Processor] Warning: Not capable of solving dependency for query {current_query}")
+                        missing = [dep for dep in dependencies if dep not in solved_dependencies]
+                        print(f"  - missing dependencies:   {missing}")
+                        print(f"  - required dependencies:  {dependencies}")
+                        print(f"  - available dependencies: {solved_dependencies}")
+                        release(query_index)
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=running.get):
+                    query_index = running.pop(future)
+                    processed, durations[sorted_indices[query_index]] = future.result()
+                    self.checkpoints.save(queries_to_process[query_index]['title'], processed)
+                    merge_results(queries_to_process[query_index]['title'], processed)
+                    release(query_index)
+        finally:
+            executor.shutdown(wait=not running, cancel_futures=True)
+
+        for query in queries_to_process:
+            query_results['queries'].extend(queries_made.get(query['title'], []))
+
+        critical_path, critical_duration = self.graph.critical_path(durations)
+        if critical_path:
+            print(f"[Query Processor] Critical path: {' -> '.join(critical_path)} ({critical_duration:.1f}s of {time.monotonic() - started:.1f}s in total)")
             
         return query_results
 
@@ -302,35 +609,10 @@ class QueryProcessor:
         Filter chat history based on placeholders and remove duplicates.
 
         Args:
-            curr_chat_history (list): The current chat history to filter.
+            curr_chat_history (ChatHistoryIndex): The current chat history to filter, indexed by placeholder values.
             filter_set (dict): The dictionary of placeholders to match against.
 
         Returns:
             list: A list of unique chat history entries that match the placeholders.
         """
-        if not curr_chat_history:
-            out = []
-        elif filter_set is None:
-            out = [ entry['chat_history'] for entry in curr_chat_history ]
-            #out = [item for sublist in filtered_chat_history for item in sublist]
-        else:
-            filtered_history = list(filter(lambda entry: all(entry.get(key) == value for key, value in filter_set.items()), curr_chat_history))
-            out = [ entry['chat_history'] for entry in filtered_history ] #chat_only
-
-        if histType == 'systemOnly':
-            out = [element for element in out if element.get('role') == 'system']
-
-        #remove repeated elements
-        if len(out) > 1:
-            unique_data = []
-            seen = set()
-            for item in out:
-                pair = (item['role'], item['content'])
-                if pair not in seen:
-                    unique_data.append(item)
-                    seen.add(pair)
-        else:
-            unique_data = out
-        #len(out) - len(unique_data)
-
-        return unique_data  # Return the unique list
+        return curr_chat_history.filter(filter_set, system_only=histType == 'systemOnly')
@@ -0,0 +1,220 @@
+import datetime
+import json
+import os
+import re
+import threading
+import time
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9, quota days follow the local time
+    ZoneInfo = None
+
+def load_timezone(name):
+    """Return the named timezone, or None to use the local time when it isn't available (e.g. tzdata missing on Windows)."""
+    if not name or ZoneInfo is None:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (KeyError, ValueError):
+        print(f"[Rate Limiter] Unknown timezone {name}, daily quotas follow the local time")
+        return None
+
+class QuotaExceededError(RuntimeError):
+    """Raised when a call would go over the daily quota of a provider."""
+
+class QuotaStore:
+    """Calls made per provider and day, saved to a JSON file so the daily quotas carry over between runs."""
+    def __init__(self, path='data/api_quota.json'):
+        self.path = path
+        self.counts = None  # provider -> {day: calls}, loaded on first use
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.counts is None:
+            self.counts = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as file:
+                    self.counts = json.load(file)
+
+    def used(self, name, day):
+        """Number of calls made to the provider on the day."""
+        with self.lock:
+            self._load()
+            return self.counts.get(name, {}).get(day, 0)
+
+    def add(self, name, day, count=1):
+        """Count calls made to the provider on the day, dropping the counts of previous days."""
+        with self.lock:
+            self._load()
+            used = self.counts.get(name, {}).get(day, 0) + count
+            self.counts[name] = {day: used}
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_file = f"{self.path}.tmp"
+            with open(tmp_file, 'w') as file:
+                json.dump(self.counts, file, indent=2)
+            os.replace(tmp_file, self.path)  # atomic, a crash never leaves a truncated file
+            return used
+
+quota_store = QuotaStore()
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting how many calls per second are let through, optionally within a daily quota.
+
+    A rate of 0 (or None) disables the limit, as does a daily quota of 0. Calls counted against the daily quota are
+    saved to the quota store, so the count carries over between runs. After a 429 response, throttle halves the rate
+    and holds every call back for the retry delay, the rate then recovers step by step with each successful call.
+    """
+    def __init__(self, rate, burst=1, name=None, daily_quota=0, quota_timezone=None, store=None):
+        self.rate = float(rate or 0)
+        self.max_rate = self.rate
+        self.burst = max(1, int(burst or 1))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.name = name
+        self.daily_quota = int(daily_quota or 0)
+        self.quota_timezone = load_timezone(quota_timezone)
+        self.store = store or quota_store
+        self.lock = threading.Lock()
+
+    def quota_day(self):
+        """Current day of the quota, in the timezone where the provider resets it."""
+        return datetime.datetime.now(self.quota_timezone).date().isoformat()
+
+    def remaining(self):
+        """Calls left today under the daily quota, None when there is no quota."""
+        if self.daily_quota <= 0:
+            return None
+        return max(0, self.daily_quota - self.store.used(self.name, self.quota_day()))
+
+    def acquire(self, cancelled=None):
+        """
+        Block until a call is allowed under the configured rate, raising QuotaExceededError once the daily quota is used up.
+
+        :param cancelled: Function checked when the call would be let through, returning True drops the call without
+            using a token or the daily quota, e.g. for a page that is no longer needed
+        :return: False when the call was dropped, True otherwise
+        """
+        while True:
+            with self.lock:
+                if cancelled is not None and cancelled():
+                    return False
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if self.rate > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if wait <= 0 and self.tokens < 1:
+                        wait = (1 - self.tokens) / self.rate
+                if wait <= 0:
+                    if self.daily_quota > 0:
+                        day = self.quota_day()
+                        if self.store.used(self.name, day) >= self.daily_quota:
+                            raise QuotaExceededError(f"The daily quota of {self.daily_quota} calls to {self.name} is used up for {day}")
+                        self.store.add(self.name, day)
+                    if self.rate > 0:
+                        self.tokens -= 1
+                    return True
+            time.sleep(wait)
+
+    def throttle(self, delay):
+        """Hold every call back for delay seconds and halve the rate, after the provider answered 429."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.rate = max(self.max_rate / 8, self.rate / 2)
+
+    def recover(self):
+        """Raise the rate back towards the configured one after a successful call."""
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+# Durations of the rate limit reset headers, e.g. '20ms', '1s' or '6m0s'
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+def parse_duration(value):
+    """Convert a rate limit reset header value into seconds."""
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in DURATION_PATTERN.findall(value or ''))
+
+class MinuteRateLimiter:
+    """
+    Thread-safe limiter of the requests and tokens sent per minute, kept in line with the rate limit headers of the responses.
+
+    The configured limits apply until a response reports the actual limits of the account. Once a response reports
+    that no requests or tokens remain, calls are held back until the reported reset time. A limit of 0 disables it.
+    """
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = float(rpm or 0)
+        self.tpm = float(tpm or 0)
+        self.requests = self.rpm
+        self.tokens = self.tpm
+        self.blocked_until = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.updated = now
+
+    def acquire(self, tokens=0):
+        """Block until a request of about tokens tokens fits in the per minute limits."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                tokens = min(tokens, self.tpm)  # a request larger than the whole budget waits for a full bucket
+                waits = [self.blocked_until - now]
+                if self.rpm > 0 and self.requests < 1:
+                    waits.append((1 - self.requests) * 60 / self.rpm)
+                if self.tpm > 0 and self.tokens < tokens:
+                    waits.append((tokens - self.tokens) * 60 / self.tpm)
+                wait = max(waits)
+                if wait <= 0:
+                    if self.rpm > 0:
+                        self.requests -= 1
+                    if self.tpm > 0:
+                        self.tokens -= tokens
+                    return
+            time.sleep(wait)
+
+    def update(self, headers):
+        """Adjust the limits and remaining budget to the x-ratelimit-* headers of a response."""
+        def header(name):
+            try:
+                return float(headers.get(f'x-ratelimit-{name}'))
+            except (TypeError, ValueError):
+                return None
+
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            limit_requests, limit_tokens = header('limit-requests'), header('limit-tokens')
+            remaining_requests, remaining_tokens = header('remaining-requests'), header('remaining-tokens')
+            if limit_requests:
+                self.requests = self.requests if self.rpm else limit_requests  # a limit learnt from the headers starts full
+                self.rpm = limit_requests
+            if limit_tokens:
+                self.tokens = self.tokens if self.tpm else limit_tokens
+                self.tpm = limit_tokens
+            if remaining_requests is not None:
+                self.requests = min(self.requests, remaining_requests)
+                if remaining_requests < 1:
+                    self.blocked_until = max(self.blocked_until, now + parse_duration(headers.get('x-ratelimit-reset-requests')))
+            if remaining_tokens is not None:
+                self.tokens = min(self.tokens, remaining_tokens)
+                if remaining_tokens < 1:
+                    self.blocked_until = max(self.blocked_until, now + parse_duration(headers.get('x-ratelimit-reset-tokens')))
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name, rate, burst=1, daily_quota=0, quota_timezone=None):
+    """Return the shared rate limiter registered under name, creating it on first use."""
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = RateLimiter(rate, burst, name, daily_quota, quota_timezone)
+        return _rate_limiters[name]
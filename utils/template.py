@@ -0,0 +1,110 @@
+import re
+from utils.ordered_set import OrderedSet
+
+PLACEHOLDER_PATTERN = re.compile(r'\[\[(.*?)\]\]')
+
+class Template:
+    """
+    Query template compiled once into literal and placeholder segments, rendered for each combination of variables.
+
+    Strings are split on their [[variable]] placeholders when the template is created, so rendering only joins the
+    segments with the variable values instead of searching every field of the query again.
+    """
+    def __init__(self, item):
+        """
+        :param item: The text or dictionary containing placeholders, dictionaries may nest and hold (label, text) tuples
+        """
+        self.variables = []  # placeholders in the order they appear, without repetition
+        self.compiled = self._compile(item)
+
+    def _add_variables(self, item):
+        """Collect the placeholders of values that are not rendered, e.g. lists, as the query still depends on them."""
+        if isinstance(item, str):
+            self.variables.extend(key for key in PLACEHOLDER_PATTERN.findall(item) if key not in self.variables)
+        elif isinstance(item, (list, tuple)):
+            for value in item:
+                self._add_variables(value)
+        elif isinstance(item, dict):
+            for value in item.values():
+                self._add_variables(value)
+
+    def _compile(self, item):
+        if isinstance(item, str):
+            segments = PLACEHOLDER_PATTERN.split(item)  # literal, variable, literal, ..., literal
+            if len(segments) == 1:
+                return ('literal', item)
+            self.variables.extend(key for key in segments[1::2] if key not in self.variables)
+            return ('text', segments)
+        elif isinstance(item, dict):
+            fields = []
+            for k, v in item.items():
+                if isinstance(v, tuple):
+                    self._add_variables(v[0])
+                    fields.append((k, (v[0],), self._compile(v[1])))
+                else:
+                    fields.append((k, None, self._compile(v)))
+            return ('dict', fields)
+        self._add_variables(item)
+        return ('literal', item)
+
+    @staticmethod
+    def list_text(value, listMode):
+        """Text of a list, in array format for array_str or as a comma separated list for list_str."""
+        if listMode == 'array_str':
+            return "[" + ", ".join(f'"{str(v)}"' if isinstance(v, str) else str(v) for v in value) + "]"
+        return ', '.join(value)
+
+    @staticmethod
+    def format_value(value, listMode, conversions=None):
+        """
+        Text of a variable value in a query.
+
+        :param listMode: array_str, converts lists to a string in array format, list_str, converts lists to a comma separated list
+        :param conversions: Dictionary caching the text of the lists already converted, so large _set values shared by many combinations are converted once
+        """
+        if isinstance(value, OrderedSet):  # memoizes its own text until it changes
+            return value.text(listMode, Template.list_text)
+        elif isinstance(value, list):  # Convert lists to a string representation
+            if conversions is not None:
+                cached = conversions.get((id(value), listMode))
+                if cached is not None and cached[0] is value:
+                    return cached[1]
+            text = Template.list_text(value, listMode)
+            if conversions is not None:
+                conversions[(id(value), listMode)] = (value, text)  # keeps the list alive, so its id isn't reused
+            return text
+        elif isinstance(value, str):
+            return value.replace('\\"', '"')
+        return value
+
+    def render(self, variables, listMode='array_str', replaced_items=None, conversions=None):
+        """
+        Replaces placeholders with the corresponding variable values.
+
+        :param variables: A dictionary of variable names and their values
+        :param listMode: array_str, converts lists to a string in array format, list_str, converts lists to a comma separated list
+        :param replaced_items: A dictionary to store the replaced items
+        :param conversions: Dictionary caching list conversions between renders, see format_value
+        :return: A tuple containing the text or dictionary with placeholders replaced and a dictionary of replaced items
+        """
+        if replaced_items is None:
+            replaced_items = {}
+        return self._render(self.compiled, variables, listMode, replaced_items, conversions), replaced_items
+
+    def _render(self, compiled, variables, listMode, replaced_items, conversions):
+        kind, content = compiled
+        if kind == 'literal':
+            return content
+        elif kind == 'text':
+            parts = list(content)
+            for i in range(1, len(parts), 2):
+                key = parts[i]
+                value = variables.get(key, f"[[{key}]]")
+                replaced_items[key] = value
+                parts[i] = self.format_value(value, listMode, conversions)
+            return "".join(parts)
+        modified_dict = {}
+        for k, label, value in content:
+            rendered = self._render(value, variables, listMode, replaced_items, conversions)
+            modified_dict[k] = label + (rendered,) if label is not None else rendered
+        return modified_dict
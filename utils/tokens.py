@@ -0,0 +1,40 @@
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # optional dependency, tokens are estimated from the text length when it isn't installed
+    tiktoken = None
+
+DEFAULT_ENCODING = 'o200k_base'  # encoding of the gpt-4o models
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def get_encoding(model=None):
+    """Return the tiktoken encoding of the model, or None when tiktoken or its encoding files aren't available."""
+    if tiktoken is None:
+        return None
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+                except KeyError:  # model unknown to this tiktoken version
+                    encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+            except Exception as e:  # the encoding files are downloaded on first use, which fails offline
+                print(f"[Tokens] tiktoken encoding unavailable, estimating tokens from the text length: {e}")
+                encoding = None
+            _encodings[model] = encoding
+        return _encodings[model]
+
+def count_tokens(text, model=None):
+    """Number of tokens of a text, counted by tiktoken when installed, otherwise about four characters per token."""
+    text = text if isinstance(text, str) else str(text or '')
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages, model=None):
+    """Number of prompt tokens of chat messages, including the few tokens framing each message."""
+    return sum(count_tokens(message.get('content'), model) + 4 for message in messages or [])
@@ -1,5 +1,6 @@
 import re
 import importlib
+from utils.template import Template
 
 class Utils:
     def __init__(self):
@@ -15,39 +16,7 @@ class Utils:
         :param replaced_items: A dictionary to store the replaced items
         :return: A tuple containing the text or dictionary with placeholders replaced and a dictionary of replaced items
         """
-
-        if replaced_items is None:
-            replaced_items = {}  # Initialize only once for the top-level call
-
-        def replace_match(match):
-            key = match.group(1)
-            value = variables.get(key, f"[[{key}]]")
-            replaced_items[key] = value
-            if isinstance(value, list):  # Convert lists to a string representation
-                if listMode == 'array_str':
-                    value = "[" + ", ".join(f'"{str(v)}"' if isinstance(v, str) else str(v) for v in value) + "]"
-                else:
-                    value = ', '.join(value)
-            elif isinstance(value, str):
-                value = value.replace('\\"', '"')
-            return value
-
-        if isinstance(item, str):
-            modified_item = re.sub(r'\[\[(.*?)\]\]', replace_match, item)
-            return modified_item, replaced_items
-
-        elif isinstance(item, dict):
-            modified_dict = {}
-            for k, v in item.items():
-                if isinstance(v, tuple):
-                    replaced_value, replaced_nested = self.replace_placeholders(v[1], variables, listMode, replaced_items)
-                    modified_dict[k] = (v[0], replaced_value)
-                else:
-                    modified_dict[k], _ = self.replace_placeholders(v, variables, listMode, replaced_items)
-            return modified_dict, replaced_items
-
-        else:
-            return item, replaced_items
+        return Template(item).render(variables, listMode, replaced_items)
 
     def reload_module(self, module_name):
         """